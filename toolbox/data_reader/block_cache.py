@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bounded in-memory cache of decoded channel blocks.
+
+Interactive sessions read overlapping windows again and again. The cache
+keeps the decoded float32 samples of data files in blocks of a fixed number
+of samples, so a later read_data call only decodes the blocks it hasn't seen
+yet. The blocks are evicted least recently used first when the memory budget
+is exceeded, and dropped when the size or mtime of their file changes.
+A block asked for while another thread is decoding it waits for that
+decoding instead of decoding it a second time.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class BlockCache(object):
+    """
+    Decoded blocks of data files, pass it to read_data or DataFile.read as the cache.
+
+    Example:
+
+    cache = BlockCache(max_bytes=512 * 2 ** 20, source=NativeCache(r'e:\MelakBridge\NativeCache'))
+    history_data = read_data(fields, cache=cache)
+    print cache.stats()
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20, block_size=65536, source=None):
+        """
+        :param max_bytes: The memory budget of the cached blocks
+        :param block_size: The number of samples per block
+        :param source: An object serving the samples through a samples(data_file, first, stop)
+            method the blocks are decoded from, e.g. a NativeCache, the data files themselves by default
+        """
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.source = source
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.attached = 0
+        self.nbytes = 0
+
+        # (file key, block number) -> samples, least recently used first
+        self._blocks = OrderedDict()
+        # file key -> (size, mtime) of the version cached and the numbers of its cached blocks
+        self._versions = {}
+        self._file_blocks = {}
+        # (file key, block number) -> Event set when the block being decoded is done
+        self._loading = {}
+
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _file_key(data_file):
+        return data_file.source, data_file.file_name
+
+    def _drop(self, block_key):
+        data = self._blocks.pop(block_key)
+        self._file_blocks[block_key[0]].discard(block_key[1])
+        self.nbytes -= data.nbytes
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._blocks:
+            self._drop(next(iter(self._blocks)))
+            self.evictions += 1
+
+    def _decode(self, data_file, block, sample_count):
+        first = block * self.block_size
+        stop = min(first + self.block_size, sample_count)
+        if self.source is not None:
+            data = self.source.samples(data_file, first, stop)
+        else:
+            data = data_file.samples(first, stop)
+        data = np.array(data, dtype=np.float32)
+        data.flags.writeable = False
+        return data
+
+    def _block(self, data_file, file_key, block, sample_count):
+        block_key = (file_key, block)
+        with self._lock:
+            data = self._blocks.pop(block_key, None)
+            if data is not None:
+                self._blocks[block_key] = data
+                self.hits += 1
+                return data
+            loading = self._loading.get(block_key)
+            if loading is None:
+                self._loading[block_key] = loading = threading.Event()
+                self.misses += 1
+                owner = True
+            else:
+                self.attached += 1
+                owner = False
+
+        if not owner:
+            # attach to the decoding in flight, decode it here only if it failed or got evicted since
+            loading.wait()
+            with self._lock:
+                data = self._blocks.get(block_key)
+            return data if data is not None else self._decode(data_file, block, sample_count)
+
+        try:
+            data = self._decode(data_file, block, sample_count)
+            with self._lock:
+                if data.nbytes <= self.max_bytes and file_key in self._versions:
+                    self._blocks[block_key] = data
+                    self._file_blocks[file_key].add(block)
+                    self.nbytes += data.nbytes
+                    self._evict()
+            return data
+        finally:
+            with self._lock:
+                del self._loading[block_key]
+            loading.set()
+
+    def contains(self, data_file, first=0, stop=None):
+        """whether all the blocks of the samples [first, stop) of the current version of the file are cached"""
+        version = data_file.stat()
+        stop = data_file.sample_count if stop is None else stop
+        file_key = self._file_key(data_file)
+        with self._lock:
+            if self._versions.get(file_key) != version:
+                return stop <= first
+            return all((file_key, block) in self._blocks
+                       for block in xrange(first // self.block_size, (stop - 1) // self.block_size + 1))
+
+    def samples(self, data_file, first=0, stop=None):
+        """the samples [first, stop) of the data file as read-only float32, decoded once per block"""
+        version = data_file.stat()
+        sample_count = data_file.sample_count
+        stop = sample_count if stop is None else stop
+        if stop <= first:
+            return np.empty(0, dtype=np.float32)
+
+        file_key = self._file_key(data_file)
+        with self._lock:
+            if self._versions.get(file_key) != version:
+                for block in list(self._file_blocks.get(file_key, ())):
+                    self._drop((file_key, block))
+                self._versions[file_key] = version
+                self._file_blocks[file_key] = set()
+
+        first_block, stop_block = first // self.block_size, (stop - 1) // self.block_size + 1
+        blocks = [self._block(data_file, file_key, block, sample_count)
+                  for block in xrange(first_block, stop_block)]
+        offset = first - first_block * self.block_size
+        if len(blocks) == 1:
+            return blocks[0][offset: offset + stop - first]
+        return np.concatenate(blocks)[offset: offset + stop - first]
+
+    def resize(self, max_bytes):
+        """change the memory budget, blocks over the new budget are evicted at once"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._versions.clear()
+            self._file_blocks.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """the counters of the cache to tune its budget"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'attached': self.attached,
+                'blocks': len(self._blocks),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+# the cache shared by the whole process, created on first use
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def shared_cache():
+    """the process-wide BlockCache, resize() it to change its budget"""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = BlockCache()
+        return _shared_cache
+
+# EOF
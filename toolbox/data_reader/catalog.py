@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent catalog of the sensor data files under a root directory.
+
+The catalog keeps one row per data file (channel, bridge station, start time,
+end time, dt, file format, byte size, mtime and path) in a sqlite database,
+members of ZIP archives included,
+so that finding the files of a query becomes an indexed lookup instead of a
+full scan of the directory tree. Directories are only re-listed and their
+file names only re-parsed when the directory's mtime has changed, and the
+readers only walk the tree for that again once the directories they look in
+have not been refreshed for max_age seconds.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import os
+import sqlite3
+import threading
+import time
+from os.path import join, isdir, normpath
+
+from data_file import create_data_file, parse_directory, to_timestamp
+
+# name of the catalog file created in the root directory by default
+CATALOG_FILE_NAME = '.pyramid_catalog.sqlite'
+
+# the seconds a refresh of a directory is trusted by refresh_stale() by default
+REFRESH_MAX_AGE = 30.0
+
+# bump this whenever the tables below change, old catalogs are rebuilt
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    directory TEXT NOT NULL,
+    archive TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    bridge_station TEXT,
+    sensor_channel TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL,
+    dt REAL NOT NULL,
+    file_format TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (directory, archive, file_name)
+);
+CREATE INDEX IF NOT EXISTS files_by_channel ON files (sensor_channel, start_time);
+'''
+
+
+class DataCatalog(object):
+    """
+    An on-disk index of the data files found under *root*.
+
+    Example:
+
+    catalog = DataCatalog(r'e:\MelakBridge\HistoryData')
+    catalog.refresh()
+    data_files = catalog.query(['SEW1111-DX'], '2015-09-01 02:00:00', '2015-09-01 05:00:00')
+    """
+
+    def __init__(self, root, catalog_file=None, max_age=REFRESH_MAX_AGE):
+        """
+        :param max_age: The seconds after which refresh_stale() refreshes a directory again,
+            None to only refresh when refresh() is called
+        """
+        if not isdir(root):
+            raise ValueError('The catalog root \'%s\' is not a valid directory' % root)
+
+        self.root = normpath(root)
+        self.catalog_file = catalog_file or join(root, CATALOG_FILE_NAME)
+        self.max_age = max_age
+
+        # directory -> time.time() of its last refresh by this catalog object
+        self._refreshed = {}
+
+        # the connection is shared by the threads reading through the catalog, one statement at a time
+        self._connection = sqlite3.connect(self.catalog_file, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._create_tables()
+
+    def _create_tables(self):
+        version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            with self._connection:
+                self._connection.execute('DROP TABLE IF EXISTS directories')
+                self._connection.execute('DROP TABLE IF EXISTS files')
+                self._connection.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def refresh(self, directories=None):
+        """
+        Bring the catalog up to date with the directory tree.
+
+        Only the directories whose mtime differs from the recorded one are
+        re-listed, directories that disappeared are dropped from the catalog.
+        :param directories: Refresh only these directories and the ones below them,
+            e.g. the directories planned by Fields.plan_directories(), optional
+        :return: The number of directories that have been re-scanned
+        """
+        if directories is None:
+            directories = [self.root]
+        refreshed = time.time()
+
+        with self._lock:
+            known_dirs = dict(self._connection.execute('SELECT path, mtime FROM directories'))
+            rescanned = 0
+
+            with self._connection:
+                for directory in directories:
+                    seen_dirs = set()
+                    for sup_dir, sub_dirs, sub_files in os.walk(directory):
+                        seen_dirs.add(sup_dir)
+                        mtime = os.stat(sup_dir).st_mtime
+                        if known_dirs.get(sup_dir) != mtime:
+                            self._scan_directory(sup_dir, sub_files, mtime)
+                            rescanned += 1
+
+                    for known_dir in known_dirs:
+                        if known_dir not in seen_dirs and \
+                                (known_dir == directory or known_dir.startswith(join(directory, ''))):
+                            self._drop_directory(known_dir)
+
+            for directory in directories:
+                self._refreshed[directory] = refreshed
+            return rescanned
+
+    def refresh_stale(self, directories=None):
+        """
+        Refresh the directories of which neither they nor a directory above them have
+        been refreshed in the last max_age seconds, none when max_age is None.
+        :return: The number of directories that have been re-scanned
+        """
+        if self.max_age is None:
+            return 0
+        if directories is None:
+            directories = [self.root]
+
+        with self._lock:
+            oldest = time.time() - self.max_age
+            fresh = [directory for directory, refreshed in self._refreshed.items() if refreshed >= oldest]
+            stale = [directory for directory in directories
+                     if not any(directory == known or directory.startswith(join(known, '')) for known in fresh)]
+            return self.refresh(stale) if stale else 0
+
+    def _drop_directory(self, directory):
+        self._connection.execute('DELETE FROM files WHERE directory = ?', (directory,))
+        self._connection.execute('DELETE FROM directories WHERE path = ?', (directory,))
+
+    def _scan_directory(self, directory, file_names, directory_mtime):
+        self._drop_directory(directory)
+
+        rows = []
+        for data_file in parse_directory(file_names, directory):
+            size, mtime = data_file.stat()
+            rows.append((
+                directory,
+                data_file.archive or '',
+                data_file.file_name,
+                data_file.bridge_station,
+                data_file.sensor_channel,
+                data_file.start_timestamp,
+                data_file.end_timestamp,
+                data_file.dt(),
+                data_file.file_format,
+                size,
+                mtime,
+            ))
+
+        self._connection.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self._connection.execute('INSERT INTO directories VALUES (?, ?)', (directory, directory_mtime))
+
+    def sensor_channels(self, bridge_station=None):
+        """the channels that have data files in the catalog"""
+        with self._lock:
+            if bridge_station:
+                rows = self._connection.execute(
+                    'SELECT DISTINCT sensor_channel FROM files WHERE bridge_station IN (?, \'\')', (bridge_station,))
+            else:
+                rows = self._connection.execute('SELECT DISTINCT sensor_channel FROM files')
+            return sorted(row[0] for row in rows)
+
+    def directories(self, sensor_channels):
+        """the directories the catalog has data files of the channels in"""
+        sensor_channels = list(sensor_channels)
+        if not sensor_channels:
+            return []
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT DISTINCT directory FROM files WHERE sensor_channel IN (%s)'
+                % ', '.join('?' * len(sensor_channels)), sensor_channels).fetchall()
+        return sorted(row[0] for row in rows)
+
+    def extents(self):
+        """
+        The time extents of all the data files without creating DataFile objects.
+        :return: The rows (sensor_channel, bridge_station, start_time, end_time, dt) ordered
+            by channel and start time, the times in milliseconds since the epoch
+        """
+        with self._lock:
+            return self._connection.execute(
+                'SELECT sensor_channel, bridge_station, start_time, end_time, dt FROM files '
+                'ORDER BY sensor_channel, start_time').fetchall()
+
+    def query(self, sensor_channels, start_time, end_time, bridge_station=None):
+        """
+        Find the data files of the given channels that overlap [start_time, end_time).
+        :param sensor_channels: The channels' names
+        :param start_time: The time data start from
+        :param end_time: The time data end to
+        :param bridge_station: The bridge station to restrict the search to, optional, the files
+            whose names carry no station are kept as the path is what tells their station then
+        :return: The list of DataFile objects ordered by channel and start time
+        """
+        sensor_channels = list(sensor_channels)
+        if not sensor_channels:
+            return []
+
+        sql = 'SELECT directory, archive, file_name FROM files ' \
+              'WHERE sensor_channel IN (%s) AND start_time < ? AND end_time > ?' \
+              % ', '.join('?' * len(sensor_channels))
+        parameters = sensor_channels + [to_timestamp(end_time), to_timestamp(start_time)]
+        if bridge_station:
+            sql += ' AND bridge_station IN (?, \'\')'
+            parameters.append(bridge_station)
+        sql += ' ORDER BY sensor_channel, start_time'
+
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        return [create_data_file(directory, file_name, archive=archive or None)
+                for directory, archive, file_name in rows]
+
+# EOF
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+"""
+Statistics of the sensor channels computed block by block.
+
+The count, NaN count, min, max, mean and the sum of squared deviations (m2)
+of the samples are computed per block of a fixed number of samples in one
+NaN-aware pass, and blocks are merged pairwise (Chan et al.) into the
+statistics of any run of blocks. The blocks are numbered on the absolute
+grid of the channel (timestamp / dt), so the engine caches them per channel:
+opening a window again costs nothing and widening it only computes the new
+blocks, the partial blocks at the edges of a window are computed every time.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import threading
+
+import numpy as np
+
+from time_series import RegularTimeIndex, SegmentedSeries
+
+STATISTICS_TYPE = np.dtype([('count', '<u8'), ('nan_count', '<u8'), ('min', '<f8'), ('max', '<f8'),
+                            ('mean', '<f8'), ('m2', '<f8')])
+
+
+def empty_statistics(size=1):
+    statistics = np.zeros(size, dtype=STATISTICS_TYPE)
+    statistics['min'] = np.NaN
+    statistics['max'] = np.NaN
+    statistics['mean'] = np.NaN
+    return statistics
+
+
+def block_statistics(data, block_size, offset=0):
+    """
+    The statistics of *data* per block of block_size samples, NaN samples are only counted.
+    :param offset: The position of data's first sample in the first block
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) == 0:
+        return empty_statistics(0)
+    starts = np.arange(-offset, len(data), block_size)
+    starts[0] = 0
+    lengths = np.diff(np.append(starts, len(data)))
+
+    valid = ~np.isnan(data)
+    statistics = np.empty(len(starts), dtype=STATISTICS_TYPE)
+    statistics['count'] = np.add.reduceat(valid, starts, dtype=np.int64)
+    statistics['nan_count'] = lengths - statistics['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        statistics['min'] = np.fmin.reduceat(data, starts)
+        statistics['max'] = np.fmax.reduceat(data, starts)
+        # the sums are taken of the samples less the block's min, so that
+        # the deviations of samples far from zero don't cancel out
+        shifted = np.where(valid, data - np.repeat(statistics['min'], lengths), 0.0)
+        sums = np.add.reduceat(shifted, starts)
+        squares = np.add.reduceat(shifted * shifted, starts)
+        statistics['mean'] = statistics['min'] + sums / statistics['count']
+        statistics['m2'] = np.maximum(squares - sums * sums / statistics['count'], 0.0)
+    statistics['m2'][statistics['count'] == 0] = 0.0
+    return statistics
+
+
+def merge_statistics(first, second):
+    """merge two statistics of the same blocks element-wise"""
+    merged = np.empty(len(first), dtype=STATISTICS_TYPE)
+    merged['count'] = first['count'] + second['count']
+    merged['nan_count'] = first['nan_count'] + second['nan_count']
+    merged['min'] = np.fmin(first['min'], second['min'])
+    merged['max'] = np.fmax(first['max'], second['max'])
+
+    first_count, second_count = first['count'].astype(np.float64), second['count'].astype(np.float64)
+    first_mean, second_mean = np.nan_to_num(first['mean']), np.nan_to_num(second['mean'])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = second_mean - first_mean
+        merged['mean'] = (first_mean * first_count + second_mean * second_count) / merged['count']
+        merged['m2'] = first['m2'] + second['m2'] + \
+            np.nan_to_num(delta * delta * first_count * second_count / merged['count'])
+    return merged
+
+
+def reduce_statistics(statistics):
+    """the statistics of all the blocks together, an array of one element"""
+    reduced = empty_statistics()
+    if len(statistics) == 0:
+        return reduced
+    counts = statistics['count'].astype(np.float64)
+    means = np.nan_to_num(statistics['mean'])
+
+    reduced['count'] = statistics['count'].sum()
+    reduced['nan_count'] = statistics['nan_count'].sum()
+    reduced['min'] = np.fmin.reduce(statistics['min'])
+    reduced['max'] = np.fmax.reduce(statistics['max'])
+    if reduced['count'][0] > 0:
+        mean = (means * counts).sum() / counts.sum()
+        reduced['mean'] = mean
+        reduced['m2'] = statistics['m2'].sum() + (counts * (means - mean) ** 2).sum()
+    return reduced
+
+
+def describe(statistics):
+    """
+    The statistics of an array of one element as a dict of count, nan_count,
+    min, max, mean, rms and std (the population standard deviation).
+    """
+    statistics = statistics[0]
+    count = int(statistics['count'])
+    variance = statistics['m2'] / count if count else np.NaN
+    return {
+        'count': count,
+        'nan_count': int(statistics['nan_count']),
+        'min': float(statistics['min']),
+        'max': float(statistics['max']),
+        'mean': float(statistics['mean']),
+        'rms': float(np.sqrt(variance + statistics['mean'] ** 2)),
+        'std': float(np.sqrt(variance)),
+    }
+
+
+class StatisticsEngine(object):
+    """
+    Statistics of the windows of channels, cached per block.
+
+    Example:
+
+    engine = StatisticsEngine()
+    history_data = read_data(fields)
+    print describe(engine.statistics('SEW1111-DX', history_data['SEW1111-DX']))
+    """
+
+    def __init__(self, block_size=65536):
+        self.block_size = block_size
+
+        # (sensor_channel, dt, phase of the grid) -> {absolute block number: statistics of the block}
+        self._blocks = {}
+        # sensor_channel -> {file key: (version, start, end)} of the data files the blocks were computed from
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, sensor_channel=None):
+        """forget the blocks of a channel whose data files have changed, of all the channels by default"""
+        with self._lock:
+            if sensor_channel is None:
+                self._blocks.clear()
+                self._sources.clear()
+                return
+            self._sources.pop(sensor_channel, None)
+            for key in [key for key in self._blocks if key[0] == sensor_channel]:
+                del self._blocks[key]
+
+    def _drop(self, sensor_channel, start, end):
+        """forget the blocks of a channel reaching into the timestamps [start, end), with the lock held"""
+        for key, cached in self._blocks.items():
+            if key[0] != sensor_channel:
+                continue
+            # the blocks are numbered on timestamp / dt, a sample of margin covers the phase of the grid
+            dt = key[1]
+            block_span = self.block_size * dt
+            for block in [block for block in cached
+                          if block * block_span - dt < end and (block + 1) * block_span + dt > start]:
+                del cached[block]
+
+    def _check_sources(self, sensor_channel, sources, start, end):
+        """
+        Forget the blocks of the data files that have changed since the blocks were computed:
+        the files grown or written again, the ones that have come and the ones that are gone
+        from the window [start, end).
+        """
+        with self._lock:
+            known = self._sources.setdefault(sensor_channel, {})
+            for key, (version, file_start, file_end) in sources.items():
+                if key not in known:
+                    # the file may fill a gap of blocks computed before it came
+                    self._drop(sensor_channel, file_start, file_end)
+                elif known[key][0] != version:
+                    self._drop(sensor_channel, min(file_start, known[key][1]), max(file_end, known[key][2]))
+                known[key] = (version, file_start, file_end)
+            for key, (_, file_start, file_end) in known.items():
+                if key not in sources and file_start < end and file_end > start:
+                    self._drop(sensor_channel, file_start, file_end)
+                    del known[key]
+
+    @staticmethod
+    def _window(series, first, stop):
+        if isinstance(series, SegmentedSeries):
+            return series.window(first, stop)
+        return series['data'][first:stop]
+
+    def statistics(self, sensor_channel, series, first=0, stop=None):
+        """
+        The statistics of the samples [first, stop) of a channel's window, the gaps count as NaN.
+        :param series: The SegmentedSeries (or TimeSeries) of the window as read_data returns it, the
+            blocks computed from data files that have changed since are computed again
+        :return: An array of one STATISTICS_TYPE element, see describe()
+        """
+        time = series.time
+        if not isinstance(time, RegularTimeIndex):
+            # the samples aren't on a grid, their blocks can't be cached
+            return reduce_statistics(block_statistics(series['data'][first:stop], self.block_size))
+        sources = getattr(series, 'sources', None)
+        if sources:
+            self._check_sources(sensor_channel, sources, time.start, time.end)
+
+        stop = time.size if stop is None else min(stop, time.size)
+        if stop <= first:
+            return empty_statistics()
+        block_size = self.block_size
+        # the absolute index of the window's sample 0 and the whole blocks in [first, stop)
+        origin = int(round(time.start / time.dt))
+        first_block = -(-(origin + first) // block_size)
+        stop_block = (origin + stop) // block_size
+        if stop_block <= first_block:
+            return reduce_statistics(block_statistics(self._window(series, first, stop), block_size))
+
+        with self._lock:
+            cached = self._blocks.setdefault((sensor_channel, time.dt, time.start % time.dt), {})
+            missing = [block for block in xrange(first_block, stop_block) if block not in cached]
+
+        # the runs of missing blocks are computed together
+        runs = []
+        for block in missing:
+            if runs and runs[-1][1] == block:
+                runs[-1][1] = block + 1
+            else:
+                runs.append([block, block + 1])
+        for run_first, run_stop in runs:
+            data = self._window(series, run_first * block_size - origin, run_stop * block_size - origin)
+            computed = block_statistics(data, block_size)
+            with self._lock:
+                for block, statistics in zip(xrange(run_first, run_stop), computed):
+                    cached[block] = statistics
+
+        parts = [block_statistics(self._window(series, first, first_block * block_size - origin), block_size),
+                 np.array([cached[block] for block in xrange(first_block, stop_block)], dtype=STATISTICS_TYPE),
+                 block_statistics(self._window(series, stop_block * block_size - origin, stop), block_size)]
+        return reduce_statistics(np.concatenate(parts))
+
+
+# the engine shared by the whole process, created on first use
+_shared_engine = None
+_shared_engine_lock = threading.Lock()
+
+
+def shared_engine():
+    """the process-wide StatisticsEngine"""
+    global _shared_engine
+    with _shared_engine_lock:
+        if _shared_engine is None:
+            _shared_engine = StatisticsEngine()
+        return _shared_engine
+
+# EOF
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""
+Coverage of the sensor channels by data files, from the catalog alone.
+
+The catalog knows the start and end time of every data file (the end derived
+from the size, the dtype's itemsize and dt as DataFile.end_time does), so the
+intervals covered by data, the number of samples and the gaps of a channel are
+found without reading any data. The extents are loaded once into arrays per
+channel, queries like "what is available for this bridge in 2016" are then
+answered with a few vectorized operations.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import numpy as np
+
+from data_file import to_timestamp
+from timemodule import DateTime, civil_from_days, days_from_civil
+
+
+def merge_intervals(starts, ends, tolerance=0.0):
+    """
+    Merge [start, end) intervals that overlap or are less than *tolerance* apart.
+    :param tolerance: A number or an array with one tolerance per interval
+    :return: The sorted starts and ends of the merged intervals
+    """
+    if len(starts) == 0:
+        return np.empty(0), np.empty(0)
+
+    order = np.argsort(starts, kind='mergesort')
+    starts, ends = starts[order], ends[order]
+    tolerance = np.broadcast_to(tolerance, starts.shape)[order]
+
+    running_end = np.maximum.accumulate(ends)
+    new_interval = np.ones(len(starts), dtype=bool)
+    new_interval[1:] = starts[1:] > running_end[:-1] + tolerance[1:]
+    firsts = np.flatnonzero(new_interval)
+    return starts[firsts], np.maximum.reduceat(ends, firsts)
+
+
+def covered_before(starts, ends, times):
+    """the covered duration before each of *times* of sorted disjoint intervals"""
+    lengths = ends - starts
+    cumulative = np.concatenate([[0.0], np.cumsum(lengths)])
+    index = np.searchsorted(starts, times, side='right') - 1
+    inside = np.clip(times - starts[np.maximum(index, 0)], 0, lengths[np.maximum(index, 0)])
+    return np.where(index >= 0, cumulative[np.maximum(index, 0)] + inside, 0.0)
+
+
+def _of_station(bridges, bridge_station):
+    """which files are of the station, files without one are of every station as in Catalog.query"""
+    return (bridges == bridge_station) | (bridges == '')
+
+
+class ChannelCoverage(object):
+    """the coverage of one channel in a time window, times in milliseconds since the epoch"""
+
+    __slots__ = ('sensor_channel', 'start', 'end', 'intervals', 'samples', 'gaps')
+
+    def __init__(self, sensor_channel, start, end, intervals, samples, gaps):
+        self.sensor_channel = sensor_channel
+        self.start = start
+        self.end = end
+        # (start, end) of the merged intervals covered by data files
+        self.intervals = intervals
+        # the number of samples the data files have in the window
+        self.samples = samples
+        # (start, end) of the parts of the window without data
+        self.gaps = gaps
+
+    @property
+    def fraction(self):
+        """the fraction of the window covered by data"""
+        covered = sum(end - start for start, end in self.intervals)
+        return covered / (self.end - self.start) if self.end > self.start else 0.0
+
+
+class CoverageIndex(object):
+    """
+    Coverage of the channels of a catalog.
+
+    Example:
+
+    index = CoverageIndex(DataCatalog(r'e:\MelakBridge\HistoryData'))
+    channels, days, fractions = index.year_matrix(2016, bridge_station='1')
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        # channel -> (starts, ends, dts, bridge stations) arrays of its data files
+        self.extents = {}
+        self.load()
+
+    def load(self):
+        """(re)load the file extents from the catalog, refresh the catalog first to see new files"""
+        rows = self.catalog.extents()
+        self.extents = {}
+        if not rows:
+            return
+
+        channels = np.array([row[0] for row in rows], dtype=object)
+        bridges = np.array([row[1] or '' for row in rows], dtype=object)
+        times = np.array([row[2:] for row in rows], dtype=np.float64)
+        # the rows are ordered by channel, split them where the channel changes
+        boundaries = np.flatnonzero(channels[1:] != channels[:-1]) + 1
+        for first, stop in zip(np.concatenate([[0], boundaries]), np.concatenate([boundaries, [len(rows)]])):
+            self.extents[channels[first]] = (times[first:stop, 0], times[first:stop, 1],
+                                             times[first:stop, 2], bridges[first:stop])
+
+    def sensor_channels(self, bridge_station=None):
+        return sorted(channel for channel, (_, _, _, bridges) in self.extents.items()
+                      if not bridge_station or _of_station(bridges, bridge_station).any())
+
+    def _channel_extents(self, sensor_channel, start, end, bridge_station=None):
+        """the files of the channel overlapping [start, end), clipped to it"""
+        if sensor_channel not in self.extents:
+            return (np.empty(0),) * 5
+        starts, ends, dts, bridges = self.extents[sensor_channel]
+        selected = (starts < end) & (ends > start)
+        if bridge_station:
+            selected &= _of_station(bridges, bridge_station)
+        starts, ends, dts = starts[selected], ends[selected], dts[selected]
+        return starts, ends, dts, np.clip(starts, start, end), np.clip(ends, start, end)
+
+    def intervals(self, sensor_channel, start, end, bridge_station=None):
+        """the sorted starts and ends of the merged intervals of [start, end) covered by the channel"""
+        start, end = to_timestamp(start), to_timestamp(end)
+        extents = self._channel_extents(sensor_channel, start, end, bridge_station)
+        if len(extents[0]) == 0:
+            return np.empty(0), np.empty(0)
+        # files less than half a sample apart are contiguous, their start times are rounded
+        return merge_intervals(extents[3], extents[4], extents[2] / 2.0)
+
+    def coverage(self, sensor_channel, start, end, bridge_station=None):
+        """the ChannelCoverage of the channel in [start, end)"""
+        start, end = to_timestamp(start), to_timestamp(end)
+        extents = self._channel_extents(sensor_channel, start, end, bridge_station)
+        if len(extents[0]) == 0:
+            return ChannelCoverage(sensor_channel, start, end, [], 0, [(start, end)] if end > start else [])
+
+        file_starts, _, dts, clipped_starts, clipped_ends = extents
+        # the samples of each file in the window, as DataFile.window counts them
+        samples = np.ceil((clipped_ends - file_starts) / dts) - np.ceil((clipped_starts - file_starts) / dts)
+        interval_starts, interval_ends = merge_intervals(clipped_starts, clipped_ends, dts / 2.0)
+
+        edges = np.concatenate([[start], interval_ends]), np.concatenate([interval_starts, [end]])
+        gaps = [(gap_start, gap_end) for gap_start, gap_end in zip(*edges) if gap_end > gap_start]
+        return ChannelCoverage(sensor_channel, start, end, zip(interval_starts, interval_ends),
+                               int(np.maximum(samples, 0).sum()), gaps)
+
+    def query(self, start, end, sensor_channels=None, bridge_station=None):
+        """the ChannelCoverage of the channels in [start, end), all the channels by default"""
+        if sensor_channels is None:
+            sensor_channels = self.sensor_channels(bridge_station)
+        return {sensor_channel: self.coverage(sensor_channel, start, end, bridge_station)
+                for sensor_channel in sensor_channels}
+
+    def day_matrix(self, start, end, sensor_channels=None, bridge_station=None):
+        """
+        The fraction of every local day in [start, end) covered by every channel.
+        :return: The channels, the DateTime of the days and the (channel, day) float matrix
+        """
+        first_day = DateTime.fromtimestamp(to_timestamp(start) / 1000.0)
+        last_day = DateTime.fromtimestamp((to_timestamp(end) - 1) / 1000.0)
+        day_numbers = np.arange(days_from_civil(first_day.year, first_day.month, first_day.day),
+                                days_from_civil(last_day.year, last_day.month, last_day.day) + 2)
+        years, months, days = civil_from_days(day_numbers)
+        dates = [DateTime(int(year), int(month), int(day)) for year, month, day in zip(years, months, days)]
+        edges = np.array([date.timestamp() for date in dates])
+
+        if sensor_channels is None:
+            sensor_channels = self.sensor_channels(bridge_station)
+        fractions = np.zeros((len(sensor_channels), len(dates) - 1))
+        for row, sensor_channel in enumerate(sensor_channels):
+            interval_starts, interval_ends = self.intervals(sensor_channel, edges[0], edges[-1], bridge_station)
+            if len(interval_starts):
+                fractions[row] = np.diff(covered_before(interval_starts, interval_ends, edges)) / np.diff(edges)
+        return sensor_channels, dates[:-1], fractions
+
+    def year_matrix(self, year, sensor_channels=None, bridge_station=None):
+        """the day_matrix of a whole year"""
+        return self.day_matrix(DateTime(year, 1, 1), DateTime(year + 1, 1, 1), sensor_channels, bridge_station)
+
+# EOF
@@ -5,17 +5,28 @@ Base class: DataFile
     subclass: DataFileYD
     subclass: DataFileND
     subclass: DataFileYS
+    subclass: DataFileChunked
 
-Factory class: DataFileFactory
+Factory function: create_data_file
+Bulk parsers: parse_many, parse_archive, parse_directory
+
+Data files are either plain files or members of the ZIP archives the
+downloader saves, members are listed from the archive's central directory
+and decompressed on demand, the archives are never extracted.
 """
 
-from datetime import timedelta
 from os import path
-from re import search
+import os
+import re
+import struct
+import zipfile
+import zlib
+from cStringIO import StringIO
 
 import numpy as np
 
-from timemodule import create_date_time
+from time_series import RegularTimeIndex, TimeSeries
+from timemodule import DateTime, create_date_time, parse_date_matrix
 
 pattern = '(?P<bridge_station>\d*)' \
           '(?P<sensor_channel>[A-Z]+\d+-?[A-Z]+\d?)#' \
@@ -37,91 +48,513 @@ DATA_TYPE = {
     'Y#S#': np.dtype([('time', np.float), ('data', np.bool)])
 }
 
+PATTERN = re.compile(pattern)
+
+# chunked containers are named after the data file they were converted from plus this suffix,
+# the file starts with a header, followed by the chunk index and the compressed chunks
+CHUNKED_SUFFIX = '.CHK'
+CHUNKED_MAGIC = 'PYRCHK01'
+CHUNKED_HEADER_TYPE = np.dtype([('magic', 'S8'), ('chunk_samples', '<u4'), ('chunk_count', '<u4'),
+                                ('sample_count', '<u8')])
+CHUNKED_INDEX_TYPE = np.dtype([('start', '<f8'), ('offset', '<u8'), ('size', '<u4')])
+CHUNKED_DATA_TYPE = np.dtype('<f4')
+
+# the first byte of the chunks coded as ADC counts, never the first byte of a zlib
+# stream (whose low nibble is 8), followed by the origin and the step of the counts
+QUANTIZED_CHUNK = 'Q'
+QUANTIZED_HEADER = struct.Struct('<dd')
+
+# the status of status text files meaning everything is normal
+STATUS_NORMAL = u'正常'.encode('gbk')
+
+
+def is_archive(file_name):
+    """whether the file is a ZIP archive of data files, e.g. '2015-09-01/SEW1111-DX.ZIP'"""
+    return file_name.upper().endswith('.ZIP')
+
+
+def _search(file_name):
+    # members of archives may be stored in folders, only their base name is parsed
+    return PATTERN.search(file_name[file_name.rfind('/') + 1:])
+
+
+def to_timestamp(value):
+    """milliseconds since the epoch of a timestamp, DateTime or anything create_date_time accepts"""
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    if not isinstance(value, DateTime):
+        value = create_date_time(value)
+    return value.timestamp()
+
+
+class DataFile(object):
+    """base class of all three types of data files
+
+    The file name is parsed once when the object is created, the derived
+    values are kept in slots instead of being searched again on every access.
+    """
 
-class DataFile:
-    """base class of all three types of data files"""
+    __slots__ = ('directory', 'file_name', 'archive', 'bridge_station', 'sensor_channel', 'file_format',
+                 '_start_string', '_start_time', '_dt', '_file_size', '_member')
+
+    def __init__(self, directory, file_name, match=None, start_time=None, archive=None):
+        """
+        :param archive: The name of the ZIP archive in directory the file is a member of,
+            file_name is then the member's name in the archive, None for plain files
+        """
+        match = match or _search(file_name)
+        if match is None:
+            raise ValueError('\'%s\' is not a valid data file name' % file_name)
 
-    def __init__(self, directory, file_name):
         self.directory = directory
         self.file_name = file_name
+        self.archive = archive
+        self.bridge_station = match.group('bridge_station')
+        self.sensor_channel = match.group('sensor_channel')
+        self.file_format = match.group('file_format1') or match.group('file_format2')
+        self._start_string = match.group('start_time')
+        self._start_time = start_time
+        self._dt = float(match.group('dt_num')) * EXCHANGE_RATE_TO_MS[match.group('dt_unit')]
+        self._file_size = None
+        # (mtime of the archive, data) of a member decompressed, kept until the archive changes
+        self._member = None
 
     @property
-    def bridge_station(self):
-        return search(pattern, self.file_name).groupdict().get('bridge_station')
+    def start_time(self):
+        if self._start_time is None:
+            self._start_time = create_date_time(self._start_string)
+        return self._start_time
 
     @property
-    def sensor_channel(self):
-        return search(pattern, self.file_name).groupdict().get('sensor_channel')
+    def start_timestamp(self):
+        """start time in milliseconds since the epoch"""
+        return self.start_time.timestamp()
 
     @property
-    def start_time(self):
-        date_string = search(pattern, self.file_name).groupdict().get('start_time')
-        return create_date_time(date_string)
+    def source(self):
+        """the path of the file on disk, the archive's path for members of an archive"""
+        return path.join(self.directory, self.archive or self.file_name)
+
+    @property
+    def file_size(self):
+        if self._file_size is None:
+            if self.archive is None:
+                self._file_size = path.getsize(self.source)
+            else:
+                with zipfile.ZipFile(self.source) as archive:
+                    self._file_size = archive.getinfo(self.file_name).file_size
+        return self._file_size
+
+    @file_size.setter
+    def file_size(self, value):
+        self._file_size = value
+
+    @property
+    def sample_count(self):
+        return self.file_size // self.data_type.itemsize
+
+    @property
+    def end_timestamp(self):
+        """end time in milliseconds since the epoch"""
+        return self.start_timestamp + self.sample_count * self._dt
 
     @property
     def end_time(self):
-        file_size = path.getsize(path.join(self.directory, self.file_name))
-        return self.start_time + timedelta(milliseconds=file_size/self.data_type.itemsize*self.dt())
+        return DateTime.fromtimestamp(self.end_timestamp / 1000.0)
 
     @property
     def data_type(self):
-        file_format1 = search(pattern, self.file_name).groupdict().get('file_format1')
-        file_format2 = search(pattern, self.file_name).groupdict().get('file_format2')
-        file_format = file_format1 if file_format1.__len__() != 0 else file_format2
-        return DATA_TYPE[file_format]
+        return DATA_TYPE[self.file_format]
 
     def dt(self, time_unit='MS'):
-        dt_num = search(pattern, self.file_name).groupdict().get('dt_num')
-        dt_unit = search(pattern, self.file_name).groupdict().get('dt_unit')
-        return float(dt_num)*EXCHANGE_RATE_TO_MS[dt_unit]/EXCHANGE_RATE_TO_MS[time_unit]
+        return self._dt / EXCHANGE_RATE_TO_MS[time_unit]
+
+    def stat(self):
+        """
+        The current version of the file, the size is the size of the data
+        (uncompressed for members) and the mtime the one of the file on disk.
+        :return: (size, mtime)
+        """
+        stat = os.stat(self.source)
+        if self.archive is None:
+            self._file_size = stat.st_size
+        return self.file_size, stat.st_mtime
+
+    def read_bytes(self, stop=None):
+        """the first *stop* bytes of the data, all of them by default"""
+        if self.archive is None:
+            with open(self.source, 'rb') as data_file:
+                return data_file.read() if stop is None else data_file.read(stop)
+        data = self._member_data()
+        return data if stop is None else data[:stop]
+
+    def _member_data(self):
+        """the whole data of a member of an archive, decompressed only once for all the reads"""
+        mtime = os.stat(self.source).st_mtime
+        if self._member is None or self._member[0] != mtime:
+            with zipfile.ZipFile(self.source) as archive:
+                self._member = (mtime, archive.read(self.file_name))
+        return self._member[1]
 
-    def read(self):
+    def window(self, start=None, end=None):
+        """
+        The samples of this file in the time window [start, end).
+        :param start: The time the window starts from, None for the file's start
+        :param end: The time the window ends to, None for the file's end
+        :return: The index of the first sample and the index after the last sample
+        """
+        sample_count = self.sample_count
+        first = 0 if start is None else \
+            int(np.ceil((to_timestamp(start) - self.start_timestamp) / self._dt))
+        stop = sample_count if end is None else \
+            int(np.ceil((to_timestamp(end) - self.start_timestamp) / self._dt))
+        first = min(max(first, 0), sample_count)
+        stop = min(max(stop, first), sample_count)
+        return first, stop
+
+    def memmap(self, first=0, stop=None):
+        """
+        map the samples [first, stop) of the file into memory, nothing else is read.
+        Members of archives are decompressed once into a read-only buffer the samples are a view of.
+        """
+        stop = self.sample_count if stop is None else stop
+        if stop <= first:
+            return np.empty(0, dtype=self.data_type)
+        if self.archive is not None:
+            item_size = self.data_type.itemsize
+            return np.frombuffer(self._member_data(), dtype=self.data_type,
+                                 count=stop - first, offset=first * item_size)
+        return np.memmap(self.source, dtype=self.data_type, mode='r',
+                         offset=first * self.data_type.itemsize, shape=(stop - first,))
+
+    def time_index(self, first=0, stop=None):
+        """the time index of the samples [first, stop) of the file"""
+        stop = self.sample_count if stop is None else stop
+        return RegularTimeIndex(self.start_timestamp + first * self._dt, self._dt, stop - first)
+
+    def samples(self, first=0, stop=None):
+        """the data of the samples [first, stop) as they are stored in the file"""
         pass
 
+    def read(self, start=None, end=None, cache=None):
+        """
+        Read the samples in the time window [start, end), the whole file by default.
+        :param cache: An object serving the samples of data files through a
+            samples(data_file, first, stop) method instead of the file itself, optional
+        :return: A TimeSeries, the data of binary files are a view of the memory-mapped file
+        """
+        first, stop = self.window(start, end)
+        if cache is not None:
+            data = cache.samples(self, first, stop)
+        else:
+            data = self.samples(first, stop)
+        return TimeSeries(self.time_index(first, stop), data)
+
 
 class DataFileYD(DataFile):
     """data files that are binary and have timestamps"""
 
-    def read(self):
-        source = path.join(self.directory, self.file_name)
-        time_data = np.fromfile(source, dtype=self.data_type, count=-1)
-        time_data['time'] = np.uint64(self.start_time.timestamp() + np.arange(time_data.size) * self.dt())
-        return time_data
+    __slots__ = ()
+
+    def samples(self, first=0, stop=None):
+        return self.memmap(first, stop)['data']
 
 
 class DataFileND(DataFile):
     """data files that are binary and have no timestamp"""
 
-    def read(self):
-        source = path.join(self.directory, self.file_name)
-        file_data = np.fromfile(source, dtype=self.data_type, count=-1)
-        file_time = np.uint64(self.start_time.timestamp() + np.arange(file_data.size) * self.dt())
-        time_data = np.zeros(file_data.size, dtype=np.dtype([('time', '>u8'), ('data', '>f4')]))
-        time_data['data'] = file_data
-        time_data['time'] = file_time
-        return time_data
+    __slots__ = ()
+
+    def samples(self, first=0, stop=None):
+        return self.memmap(first, stop)
 
 
 class DataFileYS(DataFile):
     """data files that are strings and have timestamps"""
 
-    def read(self):
-        source = path.join(self.directory, self.file_name)
-        timestamp = lambda date_str: create_date_time(date_str).timestamp()
-        gbkcmp = lambda s: u'正常' == s.decode('gbk')
-        time_data = np.loadtxt(source, dtype=self.data_type, delimiter='/', converters={0: timestamp, 1: gbkcmp})
+    __slots__ = ()
+
+    def read(self, start=None, end=None, cache=None):
+        raw = self.read_bytes()
+        time_data = parse_status_text(raw, self.data_type)
+        if time_data is None:
+            timestamp = lambda date_str: create_date_time(date_str).timestamp()
+            gbkcmp = lambda s: u'正常' == s.decode('gbk')
+            time_data = np.loadtxt(StringIO(raw), dtype=self.data_type, delimiter='/', converters={0: timestamp, 1: gbkcmp})
+        if start is not None:
+            time_data = time_data[time_data['time'] >= to_timestamp(start)]
+        if end is not None:
+            time_data = time_data[time_data['time'] < to_timestamp(end)]
         return time_data
 
 
-def create_data_file(directory, file_name):
+def _zigzag(values):
+    """int32 values as uint32, small magnitudes of either sign giving small numbers"""
+    return ((values << 1) ^ (values >> 31)).view('<u4')
+
+
+def _unzigzag(words):
+    return (words >> 1).astype(np.int32) ^ -(words & 1).astype(np.int32)
+
+
+def _planes(words):
+    """the bytes of uint32 words shuffled into one plane per byte position"""
+    return words.view(np.uint8).reshape(len(words), 4).T.tobytes()
+
+
+def _words(planes, size):
+    """the *size* uint32 words shuffled by _planes"""
+    return np.ascontiguousarray(np.frombuffer(planes, dtype=np.uint8).reshape(4, size).T).view('<u4').reshape(size)
+
+
+def _encode_quantized(data, level):
     """
-    Create object of the three subclasses of DataFile class according to given file names
+    Compress samples that are the counts of an ADC scaled to float: the counts (the samples
+    less the first one over the smallest step between samples) are delta coded, and the
+    difference of the bit patterns of the samples from the ones of the counts scaled back
+    (mostly 0 where float32 rounding is all that tells them apart) is kept alongside, so
+    the samples come back bit for bit, NaN samples included.
+    :return: The payload, None if the finite samples don't change
     """
-    if any([file_name.__contains__(x) for x in ['#T#D', '#T#H', '#Y#D']]):
-        return DataFileYD(directory, file_name)
-    elif any([file_name.__contains__(x) for x in ['#F#D', '#F#H', '#N#D']]):
-        return DataFileND(directory, file_name)
-    elif file_name.__contains__('#Y#S'):
-        return DataFileYS(directory, file_name)
+    values = data.astype(np.float64)
+    finite = np.isfinite(values)
+    if not finite.any():
+        return None
+    # the samples that aren't finite count as the first finite one, their bit patterns go in the residuals
+    origin = values[finite][0]
+    values[~finite] = origin
+    steps = np.abs(np.diff(values))
+    steps = steps[steps > 0]
+    if len(steps) == 0:
+        return None
+    step = steps.min()
+    counts = np.round((values - origin) / step)
+    if np.abs(counts).max() >= 2 ** 31:
+        return None
+
+    counts = counts.astype(np.int32)
+    residuals = data.view('<i4') - (origin + counts * step).astype(CHUNKED_DATA_TYPE).view('<i4')
+    deltas = counts.copy()
+    deltas[1:] -= counts[:-1]
+    return QUANTIZED_CHUNK + QUANTIZED_HEADER.pack(origin, step) + \
+        zlib.compress(_planes(np.concatenate((_zigzag(deltas), _zigzag(residuals)))), level)
+
+
+def encode_chunk(data, level=6):
+    """
+    Compress samples for a chunked container: the bit patterns of the samples are
+    delta coded as integers, the bytes of the deltas are shuffled into one plane
+    per byte position and the planes go through zlib. Samples that are ADC counts
+    are coded as the counts instead (see _encode_quantized) when that is smaller.
+    """
+    data = np.ascontiguousarray(data, dtype=CHUNKED_DATA_TYPE)
+    bits = data.view('<u4')
+    deltas = bits.copy()
+    deltas[1:] -= bits[:-1]
+    payload = zlib.compress(_planes(deltas), level)
+
+    quantized = _encode_quantized(data, level)
+    if quantized is not None and len(quantized) < len(payload):
+        return quantized
+    return payload
+
+
+def decode_chunk(payload, size):
+    """the *size* samples compressed by encode_chunk"""
+    if payload[:1] == QUANTIZED_CHUNK:
+        origin, step = QUANTIZED_HEADER.unpack_from(payload, 1)
+        words = _words(zlib.decompress(payload[1 + QUANTIZED_HEADER.size:]), 2 * size)
+        counts = np.cumsum(_unzigzag(words[:size]), dtype=np.int32)
+        bits = (origin + counts * step).astype(CHUNKED_DATA_TYPE).view('<i4') + _unzigzag(words[size:])
+        return bits.view(CHUNKED_DATA_TYPE)
+
+    deltas = _words(zlib.decompress(payload), size)
+    return np.cumsum(deltas, dtype=np.uint32).view(CHUNKED_DATA_TYPE)
+
+
+class DataFileChunked(DataFile):
+    """
+    data files converted into chunked containers, the samples are split into
+    chunks of a fixed duration compressed one by one, a read only decompresses
+    the chunks overlapping the window
+    """
+
+    __slots__ = ('_header', '_index')
+
+    def __init__(self, directory, file_name, match=None, start_time=None, archive=None):
+        super(DataFileChunked, self).__init__(directory, file_name, match, start_time, archive)
+        self._header = None
+        self._index = None
+
+    def _read_range(self, offset, size):
+        if self.archive is not None:
+            return self._member_data()[offset: offset + size]
+        with open(self.source, 'rb') as container:
+            container.seek(offset)
+            return container.read(size)
+
+    def chunk_index(self):
+        """the header and the chunk index of the container, read once"""
+        if self._header is None:
+            header = np.frombuffer(self._read_range(0, CHUNKED_HEADER_TYPE.itemsize), CHUNKED_HEADER_TYPE)[0]
+            if header['magic'] != CHUNKED_MAGIC:
+                raise ValueError('\'%s\' is not a chunked container' % self.file_name)
+            self._index = np.frombuffer(self._read_range(
+                CHUNKED_HEADER_TYPE.itemsize, int(header['chunk_count']) * CHUNKED_INDEX_TYPE.itemsize),
+                CHUNKED_INDEX_TYPE)
+            self._header = header
+        return self._header, self._index
+
+    @property
+    def data_type(self):
+        return CHUNKED_DATA_TYPE
+
+    @property
+    def sample_count(self):
+        return int(self.chunk_index()[0]['sample_count'])
+
+    def samples(self, first=0, stop=None):
+        header, index = self.chunk_index()
+        chunk_samples = int(header['chunk_samples'])
+        stop = int(header['sample_count']) if stop is None else stop
+        if stop <= first:
+            return np.empty(0, dtype=CHUNKED_DATA_TYPE)
+
+        first_chunk, stop_chunk = first // chunk_samples, (stop - 1) // chunk_samples + 1
+        chunks = index[first_chunk: stop_chunk]
+        payload = self._read_range(int(chunks['offset'][0]),
+                                   int(chunks['offset'][-1] + chunks['size'][-1] - chunks['offset'][0]))
+
+        data = np.empty((stop_chunk - first_chunk) * chunk_samples, dtype=CHUNKED_DATA_TYPE)
+        position = 0
+        for number, chunk in enumerate(chunks, first_chunk):
+            size = min(chunk_samples, int(header['sample_count']) - number * chunk_samples)
+            offset = int(chunk['offset'] - chunks['offset'][0])
+            data[position: position + size] = decode_chunk(payload[offset: offset + int(chunk['size'])], size)
+            position += size
+        offset = first - first_chunk * chunk_samples
+        return data[offset: offset + stop - first]
+
+
+def parse_status_text(raw, data_type=DATA_TYPE['Y#S#']):
+    """
+    Parse the content of a status text file in bulk, lines are like
+    '2015-09-01 02:00:00.000/正常' (or with a compact '20150901020000000' time)
+    with the status encoded in GBK.
+
+    All the lines are laid out in a byte matrix, the time fields are converted
+    at once by parse_date_matrix and the status is compared with the GBK bytes
+    of u'正常' row by row.
+    :return: Records of data_type, None if the lines don't share one time layout
+    """
+    lines = [line for line in raw.splitlines() if line]
+    if not lines:
+        return np.empty(0, dtype=data_type)
+
+    width = max(len(line) for line in lines)
+    matrix = np.array(lines, dtype='S%d' % width).view(np.uint8).reshape(len(lines), width)
+
+    separator = lines[0].find('/')
+    if separator < 0 or not (matrix[:, separator] == ord('/')).all():
+        return None
+    try:
+        timestamps = parse_date_matrix(matrix[:, :separator])
+    except ValueError:
+        return None
+
+    status = matrix[:, separator + 1:]
+    if status.shape[1] < len(STATUS_NORMAL):
+        normal = False
     else:
+        normal_bytes = np.zeros(status.shape[1], dtype=np.uint8)
+        normal_bytes[:len(STATUS_NORMAL)] = np.frombuffer(STATUS_NORMAL, dtype=np.uint8)
+        normal = (status == normal_bytes).all(axis=1)
+
+    time_data = np.empty(len(lines), dtype=data_type)
+    time_data['time'] = timestamps
+    time_data['data'] = normal
+    return time_data
+
+
+def create_data_file(directory, file_name, match=None, start_time=None, archive=None):
+    """
+    Create object of the three subclasses of DataFile class according to given file names
+    """
+    match = match or _search(file_name)
+    if match is None:
+        return None
+
+    data_file_class = DATA_FILE_CLASS.get(match.group('file_format1') or match.group('file_format2'))
+    if data_file_class is None:
         return None
+    if file_name.upper().endswith(CHUNKED_SUFFIX):
+        data_file_class = DataFileChunked
+    return data_file_class(directory, file_name, match, start_time, archive)
+
+
+def parse_many(file_names, directory='', archive=None):
+    """
+    Classify the files of a directory in one pass, the start times shared by
+    files of different channels are only converted once.
+    :param file_names: The names of the files in the directory
+    :param directory: The directory the files are in
+    :param archive: The archive in directory the files are members of, optional
+    :return: The list of DataFile objects, files that are not data files are left out
+    """
+    search = _search
+    start_times = {}
+    data_files = []
+    for file_name in file_names:
+        match = search(file_name)
+        if match is None:
+            continue
+        start_string = match.group('start_time')
+        start_time = start_times.get(start_string)
+        if start_time is None:
+            start_time = start_times[start_string] = create_date_time(start_string)
+        data_file = create_data_file(directory, file_name, match, start_time, archive)
+        if data_file is not None:
+            data_files.append(data_file)
+    return data_files
+
+
+def parse_archive(directory, archive):
+    """
+    Classify the members of a ZIP archive from its central directory, nothing is decompressed.
+    :return: The list of DataFile objects, empty if the archive is incomplete or corrupt
+    """
+    try:
+        with zipfile.ZipFile(path.join(directory, archive)) as zip_file:
+            members = zip_file.infolist()
+    except (zipfile.BadZipfile, IOError):
+        return []
+
+    file_sizes = {member.filename: member.file_size for member in members}
+    data_files = parse_many([member.filename for member in members], directory, archive)
+    for data_file in data_files:
+        data_file.file_size = file_sizes[data_file.file_name]
+    return data_files
+
+
+def parse_directory(file_names, directory=''):
+    """
+    Classify the files of a directory like parse_many, the members of
+    the ZIP archives among them are listed as data files as well.
+    """
+    data_files = parse_many([file_name for file_name in file_names if not is_archive(file_name)], directory)
+    for file_name in file_names:
+        if is_archive(file_name):
+            data_files.extend(parse_archive(directory, file_name))
+    return data_files
+
+
+# the subclass of DataFile to create for each file format
+DATA_FILE_CLASS = {
+    'T#D#': DataFileYD,
+    'T#H#': DataFileYD,
+    'Y#D#': DataFileYD,
+    'F#D#': DataFileND,
+    'F#H#': DataFileND,
+    'N#D#': DataFileND,
+    'Y#S#': DataFileYS,
+}
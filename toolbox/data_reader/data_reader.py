@@ -7,7 +7,8 @@ from pyface.api import ImageResource
 
 from date_time_trait import DateTime
 from plot_history_data import DataFigure
-from read_history_data import Fields, read_data
+from prefetch import Prefetcher
+from read_history_data import Fields
 
 
 class DataSpec(HasTraits):
@@ -131,6 +132,9 @@ class DataReader(Controller):
     # figure and generic info of data have been read
     data_figure = Instance(DataFigure)
 
+    # reads the windows through the shared block cache and prefetches the adjacent ones
+    prefetcher = Instance(Prefetcher, ())
+
     # main traits view to config data reader parameters
     traits_view = View(
         HGroup(
@@ -212,14 +216,18 @@ class DataReader(Controller):
 
     @on_trait_change('button_for_read')
     def read_data(self):
-        data = read_data(Fields(**{
+        fields = Fields(**{
             'root': self.model.root,
             'path': self.model.root_structure,
+            # the bridge's name only expands the directories, it is not the station in the file names
+            'bridge': self.model.bridge,
             'sensor_channel': self.model.channels,
             'start_time': self.model.start_time,
             'end_time': self.model.end_time,
-        }))
-        DataFigure(data).edit_traits()
+        })
+        data = self.prefetcher.read(fields)
+        # zooming in reads the visible span again at the plot's resolution through the same cache
+        DataFigure(data, fields, self.prefetcher.catalog, self.prefetcher.cache, reload_on_zoom=True).edit_traits()
 
     def _root_structure_set_changed(self):
         print self.root_structure_set
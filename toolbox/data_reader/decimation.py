@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decimation of the sensor channels while their data files are read.
+
+A week of a 100 Hz channel is viewed at 1 Hz far more often than at full rate.
+Instead of reading every sample into the window and leaving the downsampling
+to the caller, each data file is read in blocks of whole output bins and every
+block is reduced to its bins right away, so the full-rate samples of a file
+are never in memory at once. The bins of one channel are:
+
+    mean        the mean of the samples of each bin
+    minmax      the min and max of the samples of each bin, interleaved
+    decimate    every factor-th sample of the anti-aliased (polyphase low-pass
+                filtered) samples, computed block by block with enough context
+                to give the same samples as filtering the whole file at once
+
+The min/max/mean/count summaries of blocks are the ones the summary pyramid
+keeps as well.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import threading
+
+import numpy as np
+
+from time_series import RegularTimeIndex, SegmentedSeries
+
+SUMMARY_TYPE = np.dtype([('min', '<f4'), ('max', '<f4'), ('mean', '<f8'), ('count', '<u4')])
+
+DECIMATION_METHODS = ('mean', 'minmax', 'decimate')
+
+# the number of samples read from a data file at a time, rounded to whole bins
+READ_BLOCK_SIZE = 2 ** 18
+
+# the bins of context read on each side of a block for the polyphase filter,
+# resample_poly's filter reaches 10 * factor input samples
+FILTER_CONTEXT = 11
+
+
+def empty_summary(size):
+    summary = np.empty(size, dtype=SUMMARY_TYPE)
+    summary['min'] = np.NaN
+    summary['max'] = np.NaN
+    summary['mean'] = np.NaN
+    summary['count'] = 0
+    return summary
+
+
+def summarize(data, block_size, offset=0):
+    """
+    Summarize *data* per block of block_size samples, NaN samples are not counted.
+    :param offset: The position of data's first sample in the first block
+    """
+    block_count = (offset + len(data) + block_size - 1) // block_size
+    padded = np.empty(block_count * block_size, dtype=np.float64)
+    padded.fill(np.NaN)
+    padded[offset: offset + len(data)] = data
+    blocks = padded.reshape(block_count, block_size)
+
+    valid = ~np.isnan(blocks)
+    summary = np.empty(block_count, dtype=SUMMARY_TYPE)
+    summary['count'] = valid.sum(axis=1)
+    summary['min'] = np.fmin.reduce(blocks, axis=1)
+    summary['max'] = np.fmax.reduce(blocks, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary['mean'] = np.where(valid, blocks, 0.0).sum(axis=1) / summary['count']
+    return summary
+
+
+def merge(first, second):
+    """merge two summaries of the same blocks element-wise"""
+    merged = np.empty(len(first), dtype=SUMMARY_TYPE)
+    merged['count'] = first['count'] + second['count']
+    merged['min'] = np.fmin(first['min'], second['min'])
+    merged['max'] = np.fmax(first['max'], second['max'])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged['mean'] = (np.nan_to_num(first['mean']) * first['count'] +
+                          np.nan_to_num(second['mean']) * second['count']) / merged['count']
+    return merged
+
+
+def decimation_factor(dt, size, target_rate=None, max_points=None, method='mean'):
+    """
+    The number of samples per bin to get down to the target rate or number of points.
+    :param dt: The sampling period of the channel in milliseconds
+    :param size: The number of samples of the channel's window
+    :param target_rate: The wanted rate in Hz, optional
+    :param max_points: The most points wanted in the window, optional
+    :return: The factor, 1 when the channel needn't be decimated
+    """
+    if method not in DECIMATION_METHODS:
+        raise ValueError('unknown decimation method \'%s\', one of %s required' % (method, DECIMATION_METHODS))
+
+    factor = 1
+    if target_rate:
+        factor = max(factor, int(1000.0 / (target_rate * dt)))
+    if max_points:
+        # the min/max envelope gives two points per bin
+        points_per_bin = 2 if method == 'minmax' else 1
+        factor = max(factor, int(np.ceil(float(size) * points_per_bin / max_points)))
+    return factor
+
+
+def minmax_envelope(index, value, low, high, bins):
+    """
+    The samples of a line to draw in [low, high] on *bins* pixel columns, the
+    samples taking the min and max of each column and the first NaN of columns
+    with a gap, in their order, plus the samples just outside the range so the
+    line runs to the edges. The line drawn through them covers the same pixels
+    as the line through all the samples.
+    :param index: The sorted index (e.g. time) of the samples
+    :param value: The values of the samples
+    :return: The index and the value of the samples kept
+    """
+    index, value = np.asarray(index), np.asarray(value)
+    first = max(np.searchsorted(index, low, side='left') - 1, 0)
+    stop = min(np.searchsorted(index, high, side='right') + 1, len(index))
+    bins = max(int(bins), 1)
+    if stop - first <= 2 * bins or high <= low:
+        return index[first:stop], value[first:stop]
+
+    # the samples of each column, one pass of argmin/argmax over every column
+    edges = np.searchsorted(index, low + (high - low) / float(bins) * np.arange(bins + 1))
+    edges = np.unique(np.concatenate([[first], np.clip(edges, first, stop), [stop]]))
+    with np.errstate(invalid='ignore', over='ignore'):
+        with_gap = np.isnan(np.add.reduceat(value[first:stop], edges[:-1] - first))
+
+    kept = [first, stop - 1]
+    for column_first, column_stop, gap in zip(edges[:-1], edges[1:], with_gap):
+        column = value[column_first:column_stop]
+        if not gap:
+            kept.extend((column_first + column.argmin(), column_first + column.argmax()))
+            continue
+        # argmin stops at the first NaN, which is kept to break the line there
+        missing = np.isnan(column)
+        kept.append(column_first + missing.argmax())
+        if not missing.all():
+            kept.extend((column_first + np.nanargmin(column), column_first + np.nanargmax(column)))
+    kept = np.unique(kept)
+    return index[kept], value[kept]
+
+
+def _runs(covered):
+    """the [first, stop) ranges of the True runs of a bool array"""
+    edges = np.diff(np.concatenate([[False], covered, [False]]).astype(np.int8))
+    return zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+
+
+class Decimator(object):
+    """
+    The bins of one channel in a time window, fed file by file.
+
+    Example:
+
+    decimator = Decimator(RegularTimeIndex(start, 10.0, 8640000), 100, 'minmax')
+    for data_file in data_files:
+        decimator.add_file(data_file)
+    series = decimator.series()
+    """
+
+    def __init__(self, time, factor, method='mean'):
+        """
+        :param time: The full-rate RegularTimeIndex of the window
+        :param factor: The number of samples per bin
+        :param method: One of DECIMATION_METHODS
+        """
+        if method not in DECIMATION_METHODS:
+            raise ValueError('unknown decimation method \'%s\', one of %s required' % (method, DECIMATION_METHODS))
+        self.time = time
+        self.factor = int(factor)
+        self.method = method
+        self.bin_count = (time.size + self.factor - 1) // self.factor
+
+        if method == 'decimate':
+            self.values = np.empty(self.bin_count, dtype=np.float32)
+            self.values.fill(np.NaN)
+        else:
+            self.summary = empty_summary(self.bin_count)
+
+        # the data files read into the bins, see SegmentedSeries.add_source()
+        self.sources = {}
+        self._lock = threading.Lock()
+
+    def add_source(self, key, version, start, end):
+        with self._lock:
+            self.sources[key] = (version, start, end)
+
+    def _read_block(self, data_file, cache, first, stop):
+        if cache is not None:
+            return cache.samples(data_file, first, stop)
+        return data_file.samples(first, stop)
+
+    def add_file(self, data_file, cache=None):
+        """
+        Read the data file's samples in the window block by block into the bins.
+        :param cache: An object serving the samples through a samples(data_file, first, stop) method, optional
+        """
+        first, stop = data_file.window(self.time.start, self.time.end)
+        if stop <= first:
+            return
+        # the index in the window of the file's sample *first*
+        offset = int(round((data_file.start_timestamp + first * self.time.dt - self.time.start) / self.time.dt))
+        stop = min(stop, first + self.time.size - offset)
+
+        if self.method == 'decimate':
+            self._add_filtered(data_file, cache, first, stop, offset)
+            return
+
+        block_size = max(1, READ_BLOCK_SIZE // self.factor) * self.factor
+        position = first
+        while position < stop:
+            index = offset + position - first
+            # the blocks after the first one start on a bin
+            block_stop = min(stop, position + block_size - index % self.factor)
+            data = self._read_block(data_file, cache, position, block_stop)
+            summary = summarize(data, self.factor, index % self.factor)
+            first_bin = index // self.factor
+            with self._lock:
+                bins = self.summary[first_bin: first_bin + len(summary)]
+                self.summary[first_bin: first_bin + len(summary)] = merge(bins, summary)
+            position = block_stop
+
+    def _add_filtered(self, data_file, cache, first, stop, offset):
+        """the anti-aliased samples of the bins whose first sample lies in the file's [first, stop)"""
+        # scipy is only needed by this method
+        from scipy.signal import resample_poly
+
+        factor = self.factor
+        first_bin = (offset + factor - 1) // factor
+        stop_bin = (offset + stop - first + factor - 1) // factor
+        bins_per_block = max(1, READ_BLOCK_SIZE // factor)
+        for block_first in xrange(first_bin, stop_bin, bins_per_block):
+            block_stop = min(block_first + bins_per_block, stop_bin)
+            # the window indexes of the input, the file's edge samples are repeated outside it
+            input_first = (block_first - FILTER_CONTEXT) * factor
+            input_stop = (block_stop + FILTER_CONTEXT) * factor
+            inside_first = max(input_first, offset)
+            inside_stop = min(input_stop, offset + stop - first)
+            data = self._read_block(data_file, cache, first + inside_first - offset, first + inside_stop - offset)
+            data = np.pad(np.asarray(data, dtype=np.float64),
+                          (inside_first - input_first, input_stop - inside_stop), mode='edge')
+            filtered = resample_poly(data, 1, factor)
+            with self._lock:
+                self.values[block_first: block_stop] = \
+                    filtered[FILTER_CONTEXT: FILTER_CONTEXT + block_stop - block_first]
+
+    def series(self):
+        """
+        The bins as a SegmentedSeries, timestamped at the start of their bin. The min/max
+        envelope is on a grid of half a bin, the min of each bin first.
+        """
+        bin_dt = self.time.dt * self.factor
+        if self.method == 'decimate':
+            series = SegmentedSeries(RegularTimeIndex(self.time.start, bin_dt, self.bin_count))
+            for first, stop in _runs(~np.isnan(self.values)):
+                series.add(first, self.values[first:stop])
+        elif self.method == 'mean':
+            series = SegmentedSeries(RegularTimeIndex(self.time.start, bin_dt, self.bin_count))
+            for first, stop in _runs(self.summary['count'] > 0):
+                series.add(first, self.summary['mean'][first:stop].astype(np.float32))
+        else:
+            series = SegmentedSeries(RegularTimeIndex(self.time.start, bin_dt / 2.0, 2 * self.bin_count))
+            for first, stop in _runs(self.summary['count'] > 0):
+                envelope = np.column_stack((self.summary['min'][first:stop], self.summary['max'][first:stop]))
+                series.add(2 * first, envelope.ravel())
+        series.sources = dict(self.sources)
+        return series
+
+# EOF
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless extraction of history data for batch jobs.
+
+    python extract_cmd.py query.json -o e:\Extracted --format npy --workers 4
+
+The query is a JSON object or the [query] section of an INI file giving the
+fields of the search: root, path, bridge_station, bridge (the name the {bridge}
+field of the path expands to), sensor_channel (a list, or comma separated in
+INI files), start_time and end_time. Every channel is streamed chunk by chunk
+into one of the outputs:
+
+    npy     <channel>.npy with the float32 samples of the whole window, NaN in gaps
+    npz     <query name>.npz with the arrays of the npy output
+    raw     <channel>.f4, little-endian float32 samples of the whole window, NaN in gaps
+    csv     <channel>_<n>.csv files of time (ms), data rows of the covered samples
+
+The grid (start and dt in milliseconds, size) of every channel is written to
+manifest.json beside the outputs. Only numpy is needed, no GUI toolkit is imported.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import argparse
+import ConfigParser
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from copy import copy
+from multiprocessing.pool import ThreadPool
+from os.path import join, isdir, basename, splitext
+
+import numpy as np
+
+from read_history_data import Fields, iter_data
+from time_series import RegularTimeIndex
+
+# the fields a query may give
+QUERY_FIELDS = ('root', 'path', 'bridge_station', 'bridge', 'sensor_channel', 'start_time', 'end_time')
+
+OUTPUT_FORMATS = ('npy', 'npz', 'raw', 'csv')
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+
+def load_query(query_file):
+    """the fields of the query in a JSON file, or in the [query] section of an INI file"""
+    if splitext(query_file)[1].lower() in ('.ini', '.cfg'):
+        config = ConfigParser.ConfigParser()
+        config.read(query_file)
+        query = {key: value.decode('utf-8') for key, value in config.items('query') if key in QUERY_FIELDS}
+        if 'sensor_channel' in query:
+            query['sensor_channel'] = [channel.strip() for channel in query['sensor_channel'].split(',')
+                                       if channel.strip()]
+    else:
+        with open(query_file, 'r') as json_file:
+            query = {key: value for key, value in json.load(json_file).items() if key in QUERY_FIELDS}
+    return Fields(**query)
+
+
+class ChannelWriter(object):
+    """base class of the writers streaming the chunks of one channel into its output"""
+
+    def __init__(self, directory, sensor_channel, time):
+        """
+        :param time: The RegularTimeIndex of the channel's whole window
+        """
+        self.directory = directory
+        self.sensor_channel = sensor_channel
+        self.time = time
+        self.samples = 0
+        self.file_names = []
+
+    def write(self, series):
+        """write the next chunk of the window"""
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def nbytes(self):
+        return sum(os.path.getsize(join(self.directory, file_name)) for file_name in self.file_names)
+
+
+class RawWriter(ChannelWriter):
+    """little-endian float32 samples of the whole window, NaN in the gaps"""
+
+    suffix = '.f4'
+
+    def __init__(self, directory, sensor_channel, time):
+        super(RawWriter, self).__init__(directory, sensor_channel, time)
+        self.file_names.append(sensor_channel + self.suffix)
+        self.output = open(join(directory, self.file_names[0]), 'wb')
+        self.write_header()
+
+    def write_header(self):
+        pass
+
+    def write(self, series):
+        data = series.densify()['data']
+        self.samples += int(np.count_nonzero(~np.isnan(data)))
+        self.output.write(data.astype('<f4').tobytes())
+
+    def close(self):
+        self.output.close()
+
+
+class NpyWriter(RawWriter):
+    """a .npy file of the float32 samples of the whole window, NaN in the gaps"""
+
+    suffix = '.npy'
+
+    def write_header(self):
+        np.lib.format.write_array_header_1_0(
+            self.output, {'descr': '<f4', 'fortran_order': False, 'shape': (self.time.size,)})
+
+
+class CsvWriter(ChannelWriter):
+    """time (ms), data rows of the covered samples, split into files of *rows* rows"""
+
+    rows = 1000000
+
+    def __init__(self, directory, sensor_channel, time):
+        super(CsvWriter, self).__init__(directory, sensor_channel, time)
+        self.output = None
+        self.rows_written = 0
+
+    def _next_file(self):
+        if self.output is not None:
+            self.output.close()
+        self.file_names.append('%s_%04d.csv' % (self.sensor_channel, len(self.file_names)))
+        self.output = open(join(self.directory, self.file_names[-1]), 'w')
+        self.output.write('time,data\n')
+        self.rows_written = 0
+
+    def write(self, series):
+        for covered_first, covered_stop in series.coverage():
+            times = np.round(series.time[covered_first:covered_stop].values(np.float64)).astype(np.int64)
+            data = series.window(covered_first, covered_stop)
+            while len(times):
+                if self.output is None or self.rows_written >= self.rows:
+                    self._next_file()
+                count = min(len(times), self.rows - self.rows_written)
+                # formatting the rows as one string is several times faster than np.savetxt
+                self.output.write(''.join('%d,%.7g\n' % row for row in zip(times[:count].tolist(),
+                                                                          data[:count].tolist())))
+                self.rows_written += count
+                self.samples += count
+                times, data = times[count:], data[count:]
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+
+
+WRITER_CLASS = {
+    'npy': NpyWriter,
+    'npz': NpyWriter,
+    'raw': RawWriter,
+    'csv': CsvWriter,
+}
+
+
+def extract_channel(fields, sensor_channel, directory, output_format, chunk_size):
+    """
+    Stream the samples of one channel into its output.
+    :return: The manifest entry of the channel, None if it has no data in the window
+    """
+    channel_fields = copy(fields)
+    channel_fields.sensor_channel = [sensor_channel]
+
+    writer = None
+    for _, series in iter_data(channel_fields, size=chunk_size, read_ahead=1):
+        if writer is None:
+            start, dt = series.time.start, series.time.dt
+            size = int(np.ceil((channel_fields.end_time.timestamp() - start) / dt))
+            writer = WRITER_CLASS[output_format](directory, sensor_channel, RegularTimeIndex(start, dt, size))
+        writer.write(series)
+
+    if writer is None:
+        return None
+    writer.close()
+    return {
+        'files': writer.file_names,
+        'start': writer.time.start,
+        'dt': writer.time.dt,
+        'size': writer.time.size,
+        'samples': writer.samples,
+        'bytes': writer.nbytes,
+    }
+
+
+def pack_npz(directory, npz_file, manifest):
+    """move the .npy outputs of the channels into one .npz archive"""
+    with zipfile.ZipFile(npz_file, 'w', zipfile.ZIP_STORED, allowZip64=True) as npz:
+        for entry in manifest.values():
+            if entry is None:
+                continue
+            for file_name in entry['files']:
+                npz.write(join(directory, file_name), file_name)
+            entry['files'] = [basename(npz_file)]
+
+
+def extract(fields, directory, output_format='npy', workers=1, chunk_size=2 ** 20, name='history_data'):
+    """
+    Extract the channels of fields into directory.
+    :param workers: The number of channels extracted at the same time
+    :param chunk_size: The number of samples per channel read at a time
+    :return: The manifest, a dict of channel -> grid, files, samples and bytes written
+    """
+    if not isdir(directory):
+        os.makedirs(directory)
+
+    target = tempfile.mkdtemp(dir=directory) if output_format == 'npz' else directory
+    try:
+        tasks = [(fields, sensor_channel, target, output_format, chunk_size)
+                 for sensor_channel in fields.sensor_channel]
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                entries = pool.map(lambda task: extract_channel(*task), tasks, chunksize=1)
+            finally:
+                pool.close()
+        else:
+            entries = [extract_channel(*task) for task in tasks]
+        manifest = dict(zip(fields.sensor_channel, entries))
+
+        if output_format == 'npz':
+            pack_npz(target, join(directory, name + '.npz'), manifest)
+    finally:
+        if output_format == 'npz':
+            shutil.rmtree(target)
+
+    with open(join(directory, MANIFEST_FILE_NAME), 'w') as manifest_file:
+        json.dump({'format': output_format, 'channels': manifest}, manifest_file, indent=2)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract history data without a display.')
+    parser.add_argument('query', help='JSON file, or INI file with a [query] section, of the search fields')
+    parser.add_argument('-o', '--output', required=True, help='the directory to write the outputs to')
+    parser.add_argument('-f', '--format', choices=OUTPUT_FORMATS, default='npy', help='the output format')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='the number of channels extracted at once')
+    parser.add_argument('--chunk-size', type=int, default=2 ** 20, help='the samples per channel read at a time')
+    parser.add_argument('--csv-rows', type=int, default=CsvWriter.rows, help='the rows per CSV file')
+    arguments = parser.parse_args(argv)
+
+    CsvWriter.rows = arguments.csv_rows
+    fields = load_query(arguments.query)
+
+    start = time.time()
+    manifest = extract(fields, arguments.output, arguments.format, arguments.workers, arguments.chunk_size,
+                       splitext(basename(arguments.query))[0])
+    elapsed = max(time.time() - start, 1e-6)
+
+    samples, output_bytes = 0, 0
+    for sensor_channel in fields.sensor_channel:
+        entry = manifest[sensor_channel]
+        if entry is None:
+            print '%s: no data' % sensor_channel
+            continue
+        samples += entry['samples']
+        output_bytes += entry['bytes']
+        print '%s: %d samples every %g ms' % (sensor_channel, entry['samples'], entry['dt'])
+
+    print 'extracted %d samples, %.1f MB in %.1f s: %.0f samples/s, %.1f MB/s' % (
+        samples, output_bytes / 1e6, elapsed, samples / elapsed, output_bytes / 1e6 / elapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# EOF
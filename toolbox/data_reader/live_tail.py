@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""
+Live tail of the data files being acquired.
+
+The acquisition system writes the current hour's file of every channel while
+it acquires it. The directories the channels' current files are in are
+watched (inotify on Linux, listing them at an interval elsewhere), and only
+the samples appended to the binary files (DataFileYD/DataFileND) since they
+were last read are read. They go into a ring buffer per channel keeping the
+latest samples, which a plot takes snapshots of at its own refresh rate.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from datetime import timedelta
+from os.path import join
+
+import numpy as np
+
+from data_file import DataFileYD, DataFileND, parse_many
+from path_template import PathTemplate
+from time_series import TimeSeries
+from timemodule import DateTime
+
+# inotify events of interest, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# wd, mask, cookie and length of the name following the header of an inotify event
+EVENT_HEADER = struct.Struct('iIII')
+
+logger = logging.getLogger(__name__)
+
+
+class PollingWatcher(object):
+    """changes of the files of the watched directories, found by listing them at an interval"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        # directory -> {file name: (size, mtime)} of the last listing
+        self._directories = {}
+
+    @staticmethod
+    def _list(directory):
+        versions = {}
+        try:
+            file_names = os.listdir(directory)
+        except OSError:
+            return versions
+        for file_name in file_names:
+            try:
+                stat = os.stat(join(directory, file_name))
+            except OSError:
+                continue
+            versions[file_name] = (stat.st_size, stat.st_mtime)
+        return versions
+
+    def watch(self, directory):
+        """watch the directory, which may not exist yet, :return: True"""
+        if directory not in self._directories:
+            self._directories[directory] = self._list(directory)
+        return True
+
+    def changes(self, timeout):
+        """:return: The (directory, file name) of the files created or changed since the last call"""
+        time.sleep(min(timeout, self.interval))
+        changed = []
+        for directory, versions in self._directories.items():
+            current = self._list(directory)
+            changed.extend((directory, file_name) for file_name, version in current.items()
+                           if versions.get(file_name) != version)
+            self._directories[directory] = current
+        return changed
+
+    def close(self):
+        self._directories = {}
+
+
+class InotifyWatcher(object):
+    """changes of the files of the watched directories, reported by inotify through ctypes"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # watch descriptor -> directory
+        self._watches = {}
+
+    def watch(self, directory):
+        """watch the directory, :return: False if it can't be watched (yet)"""
+        if directory in self._watches.values():
+            return True
+        path = directory.encode(sys.getfilesystemencoding()) if isinstance(directory, unicode) else directory
+        watch_descriptor = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+        if watch_descriptor < 0:
+            return False
+        self._watches[watch_descriptor] = directory
+        return True
+
+    def changes(self, timeout):
+        """
+        :return: The (directory, file name) of the files created or changed since the last call,
+            the file name is None when events have been lost and the directory must be listed
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            events = os.read(self._fd, 65536)
+        except OSError as error:
+            if error.errno == errno.EAGAIN:
+                return []
+            raise
+
+        changed = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(events):
+            watch_descriptor, mask, _, length = EVENT_HEADER.unpack_from(events, offset)
+            offset += EVENT_HEADER.size
+            file_name = events[offset: offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.extend((directory, None) for directory in self._watches.values())
+            elif mask & IN_IGNORED:
+                # the directory has been removed
+                self._watches.pop(watch_descriptor, None)
+            elif watch_descriptor in self._watches and file_name:
+                changed.append((self._watches[watch_descriptor], file_name))
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+        self._watches = {}
+
+
+def create_watcher(interval=1.0):
+    """an InotifyWatcher on Linux, a PollingWatcher listing the directories every *interval* seconds elsewhere"""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            # inotify is not available from this libc
+            pass
+    return PollingWatcher(interval)
+
+
+class RingBuffer(object):
+    """the latest *capacity* samples of a channel, times in milliseconds since the epoch"""
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.time = np.empty(self.capacity, dtype=np.float64)
+        self.data = np.empty(self.capacity, dtype=np.float32)
+        self.size = 0
+        # the time of the latest sample and the number of extends, to tell a snapshot is outdated
+        self.last_time = -np.inf
+        self.version = 0
+
+        # the position after the latest sample
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def _put(self, time, data):
+        first = self._end
+        count = min(len(data), self.capacity - first)
+        self.time[first: first + count], self.data[first: first + count] = time[:count], data[:count]
+        self.time[:len(data) - count], self.data[:len(data) - count] = time[count:], data[count:]
+        self._end = (first + len(data)) % self.capacity
+        self.size = min(self.size + len(data), self.capacity)
+
+    def extend(self, time, data, dt=None):
+        """
+        Append samples, the ones not later than the latest sample are left out.
+        :param dt: The sampling period, a NaN sample is put between samples more than 1.5 dt apart
+        """
+        time, data = np.asarray(time, dtype=np.float64), np.asarray(data, dtype=np.float32)
+        later = time > self.last_time
+        if not later.all():
+            time, data = time[later], data[later]
+        if len(time) == 0:
+            return
+
+        with self._lock:
+            if dt is not None and self.size and time[0] - self.last_time > 1.5 * dt:
+                # break the line over the gap
+                self._put(np.array([self.last_time + dt]), np.array([np.NaN], dtype=np.float32))
+            self._put(time[-self.capacity:], data[-self.capacity:])
+            self.last_time = time[-1]
+            self.version += 1
+
+    def values(self):
+        """a TimeSeries copy of the samples, oldest first"""
+        with self._lock:
+            first = (self._end - self.size) % self.capacity
+            if first + self.size <= self.capacity:
+                return TimeSeries(self.time[first: first + self.size].copy(),
+                                  self.data[first: first + self.size].copy())
+            return TimeSeries(np.concatenate([self.time[first:], self.time[:self._end]]),
+                              np.concatenate([self.data[first:], self.data[:self._end]]))
+
+
+class FileTail(object):
+    """the samples appended to a growing binary data file since it was read last"""
+
+    def __init__(self, data_file, position=0):
+        """
+        :param position: The index of the first sample not read yet
+        """
+        self.data_file = data_file
+        self.position = position
+
+    def read(self):
+        """:return: A TimeSeries of the whole samples appended, None if there are none"""
+        self.data_file.stat()
+        sample_count = self.data_file.sample_count
+        if sample_count < self.position:
+            # the file has been written again from the start
+            self.position = 0
+        if sample_count == self.position:
+            return None
+
+        first, self.position = self.position, sample_count
+        # only the bytes of the new samples are mapped
+        data = np.array(self.data_file.samples(first, sample_count), dtype=np.float32)
+        return TimeSeries(self.data_file.time_index(first, sample_count), data)
+
+
+class LiveTail(object):
+    """
+    Tail the data files of the channels of fields while they are acquired.
+
+    Example:
+
+    tail = LiveTail(fields, capacity=360000)
+    tail.start()
+    series = tail.buffers['SEW1111-DX'].values()
+    tail.stop()
+    """
+
+    def __init__(self, fields, capacity=360000, watcher=None, interval=1.0, backfill=True):
+        """
+        :param capacity: The number of samples kept per channel
+        :param watcher: The watcher of the directories, create_watcher(interval) by default
+        :param interval: The most seconds to wait for changes in one step of the loop
+        :param backfill: Whether the buffers start with the latest samples written before, up to capacity
+        """
+        self.fields = fields
+        self.buffers = {sensor_channel: RingBuffer(capacity) for sensor_channel in fields.sensor_channel}
+        self.watcher = watcher if watcher is not None else create_watcher(interval)
+        self.interval = interval
+        self.backfill = backfill
+
+        # (directory, file name) -> FileTail of the files of the channels seen
+        self._tails = {}
+        self._directories = set()
+
+        # the exception that stopped the background thread, None while it runs or was stopped
+        self.error = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def directories(self, now=None):
+        """the directories the channels' files are written to at *now* and an hour before"""
+        now = DateTime.now() if now is None else now
+        template = PathTemplate(self.fields.path)
+        return set(template.format(self.fields.root, self.fields.bridge_station, sensor_channel, moment,
+                                   self.fields.bridge)
+                   for sensor_channel in self.fields.sensor_channel
+                   for moment in (now - timedelta(hours=1), now))
+
+    def _watch(self, directory):
+        if directory in self._directories or not self.watcher.watch(directory):
+            return
+        self._directories.add(directory)
+        self.update(directory, initial=True)
+
+    def update(self, directory, file_names=None, initial=False):
+        """
+        Read the samples appended to the data files among file_names in directory.
+        :param file_names: The names of the files changed, all the files of the directory by default
+        :param initial: Whether the files were there before the directory was watched, only their
+            latest samples up to the buffer's capacity are read then, none unless backfilling
+        """
+        if file_names is None:
+            try:
+                file_names = os.listdir(directory)
+            except OSError:
+                return
+        data_files = [data_file for data_file in parse_many(file_names, directory)
+                      if data_file.sensor_channel in self.buffers and isinstance(data_file, (DataFileYD, DataFileND))]
+
+        # the files of a channel go into its buffer in the order of their start
+        for data_file in sorted(data_files, key=lambda data_file: data_file.start_timestamp):
+            key = (directory, data_file.file_name)
+            try:
+                tail = self._tails.get(key)
+                if tail is None:
+                    position = 0
+                    if initial:
+                        buffer = self.buffers[data_file.sensor_channel]
+                        horizon = DateTime.now().timestamp() - buffer.capacity * data_file.dt()
+                        position = data_file.window(horizon)[0] if self.backfill else data_file.sample_count
+                    tail = self._tails[key] = FileTail(data_file, position)
+                series = tail.read()
+            except (IOError, OSError, ValueError):
+                # the file has been moved away or is not readable yet, the next change will tell
+                continue
+            if series is not None:
+                self.buffers[data_file.sensor_channel].extend(
+                    series.time.values(np.float64), series.data, data_file.dt())
+
+    def poll(self, timeout=None):
+        """one step of the loop: watch the current directories and read what has been appended"""
+        for directory in self.directories():
+            self._watch(directory)
+
+        changes = {}
+        for directory, file_name in set(self.watcher.changes(self.interval if timeout is None else timeout)):
+            if directory not in self._directories:
+                continue
+            if file_name is None:
+                changes[directory] = None
+            elif changes.get(directory, ()) is not None:
+                changes.setdefault(directory, []).append(file_name)
+        for directory, file_names in changes.items():
+            self.update(directory, file_names)
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set():
+                self.poll()
+        except Exception as error:
+            # a bad path template or an unreadable directory would fail every step alike
+            logger.exception('live tail of %s stopped', ', '.join(self.fields.sensor_channel))
+            self.error = error
+            self._stopped.set()
+
+    def start(self):
+        """tail the files on a background thread"""
+        if self._thread is None:
+            self._stopped.clear()
+            self.error = None
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.watcher.close()
+
+# EOF
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Native-endian cache of the binary data files.
+
+The archive stores big-endian '>f4' samples, every NumPy operation on them
+has to swap the bytes first. The cache converts the data column of a file
+once into a contiguous native-endian .npy file and serves later reads of
+the same file from it through memory mapping. Cached files are keyed by the
+path, size and mtime of the source file, a changed source is converted again.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import errno
+import glob
+import hashlib
+import os
+import tempfile
+from os.path import join, isdir, isfile, abspath
+
+import numpy as np
+
+
+class NativeCache(object):
+    """
+    A directory of native-endian copies of data files, pass it to read_data
+    or DataFile.read as the cache.
+
+    Example:
+
+    cache = NativeCache(r'e:\MelakBridge\NativeCache')
+    history_data = read_data(fields, cache=cache)
+    """
+
+    def __init__(self, root):
+        if not isdir(root):
+            os.makedirs(root)
+        self.root = root
+
+    @staticmethod
+    def _source_key(data_file):
+        source = abspath(data_file.source)
+        if data_file.archive is not None:
+            source = join(source, data_file.file_name)
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        return hashlib.sha1(source).hexdigest()
+
+    def cache_path(self, data_file):
+        """the cached file of the data file's current version"""
+        size, mtime = data_file.stat()
+        return join(self.root, '%s-%d-%d.npy' % (self._source_key(data_file), size, int(mtime * 1000)))
+
+    @staticmethod
+    def _version(cache_path):
+        """the (mtime, size) of the source a cached file was converted from"""
+        size, mtime = os.path.basename(cache_path)[:-len('.npy')].split('-')[1:]
+        return int(mtime), int(size)
+
+    def convert(self, data_file, cache_path):
+        """
+        Write the data column of the file to cache_path in native byte order, then
+        remove the cached files of the file's older versions.
+        """
+        data = data_file.samples()
+        handle, temp_path = tempfile.mkstemp(suffix='.npy', dir=self.root)
+        with os.fdopen(handle, 'wb') as temp_file:
+            np.save(temp_file, np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('=')))
+        try:
+            os.rename(temp_path, cache_path)
+        except OSError:
+            # another thread has converted the same file in the mean time
+            os.remove(temp_path)
+
+        # the older versions are removed only once this one is in place, and a version a reader
+        # may have looked up in the mean time (a later one, converted by another thread) is kept
+        for stale_path in glob.glob(join(self.root, self._source_key(data_file) + '-*.npy')):
+            if self._version(stale_path) >= self._version(cache_path):
+                continue
+            try:
+                os.remove(stale_path)
+            except OSError as error:
+                # removed by another conversion already, or mapped by a reader on Windows,
+                # where it is left for the next conversion
+                if error.errno not in (errno.ENOENT, errno.EACCES, errno.EPERM):
+                    raise
+
+    def samples(self, data_file, first=0, stop=None):
+        """the samples [first, stop) of the data file, converted the first time they are asked for"""
+        for retry in (False, True):
+            cache_path = self.cache_path(data_file)
+            if not isfile(cache_path):
+                self.convert(data_file, cache_path)
+            try:
+                return np.load(cache_path, mmap_mode='r')[first:stop]
+            except IOError as error:
+                # the source changed after it was looked up and a conversion of the
+                # new version removed this one, the new version is looked up again
+                if retry or error.errno != errno.ENOENT:
+                    raise
+
+# EOF
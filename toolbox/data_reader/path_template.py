@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+Path templates describing where data files are stored under the root directory,
+e.g. r'{root}\{datetime:%Y%m%d}\{sensor_channel}' or the root structure
+u'{root}/{bridge}/{datetime:%Y}/{datetime:%m%d}/{channel}' described in the data reader.
+
+A template is expanded with the search conditions into the exact set of
+directories that may contain the wanted data files, so the data reader
+visits only those instead of walking the whole root directory.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import os
+import re
+from datetime import datetime, timedelta
+
+# datetime directives grouped by the time unit they distinguish, finest first
+TIME_UNIT_DIRECTIVES = [
+    ('minute', 'MRTXc'),
+    ('hour', 'HIpk'),
+    ('day', 'dejaAwuUWVx'),
+    ('month', 'mbBh'),
+    ('year', 'YyCG'),
+]
+
+DATETIME_FIELD = re.compile(r'\{datetime:([^}]*)\}')
+
+
+def normalize_path(path):
+    """Use the platform's separator whatever the separators in *path* are"""
+    return os.path.normpath(path.replace('\\', os.sep).replace('/', os.sep))
+
+
+def floor_time(date_time, time_unit):
+    if time_unit == 'minute':
+        return date_time.replace(second=0, microsecond=0)
+    elif time_unit == 'hour':
+        return date_time.replace(minute=0, second=0, microsecond=0)
+    elif time_unit == 'day':
+        return date_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif time_unit == 'month':
+        return date_time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        return date_time.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def shift_time(date_time, time_unit, count=1):
+    if time_unit == 'minute':
+        return date_time + timedelta(minutes=count)
+    elif time_unit == 'hour':
+        return date_time + timedelta(hours=count)
+    elif time_unit == 'day':
+        return date_time + timedelta(days=count)
+    elif time_unit == 'month':
+        months = date_time.year * 12 + date_time.month - 1 + count
+        return date_time.replace(year=months // 12, month=months % 12 + 1)
+    else:
+        return date_time.replace(year=date_time.year + count)
+
+
+class PathTemplate(object):
+    """
+    The description of the directories data files are stored in.
+
+    Supported fields:
+        {root}                              the root directory
+        {bridge_station}                    the bridge station
+        {bridge}                            the bridge's name, the bridge station by default
+        {sensor_channel} or {channel}       the sensor channel, e.g. SAD0101-DX
+        {sensor}                            the sensor of the channel, e.g. SAD0101
+        {datetime:<format>}                 the time formatted as strftime does
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.time_unit = self._detect_time_unit(template)
+
+    @staticmethod
+    def _detect_time_unit(template):
+        directives = ''.join(re.findall(r'%(\w)', ''.join(DATETIME_FIELD.findall(template))))
+        for time_unit, unit_directives in TIME_UNIT_DIRECTIVES:
+            if any(directive in unit_directives for directive in directives):
+                return time_unit
+        return None
+
+    @property
+    def plannable(self):
+        """whether the template is anchored on the root and only uses the supported fields"""
+        if not self.template.startswith('{root}'):
+            return False
+        try:
+            self.format('', '', 'A0-B', datetime(2000, 1, 1))
+        except (KeyError, IndexError, ValueError):
+            return False
+        return True
+
+    def format(self, root, bridge_station, sensor_channel, date_time, bridge=None):
+        return normalize_path(self.template.format(
+            root=root,
+            bridge_station=bridge_station,
+            bridge=bridge_station if bridge is None else bridge,
+            sensor_channel=sensor_channel,
+            channel=sensor_channel,
+            sensor=sensor_channel.split('-')[0],
+            datetime=date_time,
+        ))
+
+    def times(self, start_time, end_time):
+        """
+        All the distinct times the template distinguishes between start_time and end_time.
+        One period before start_time is included, files started in it may reach into the window.
+        """
+        if self.time_unit is None:
+            return [None]
+
+        times = []
+        date_time = shift_time(floor_time(start_time, self.time_unit), self.time_unit, -1)
+        while date_time < end_time:
+            times.append(date_time)
+            date_time = shift_time(date_time, self.time_unit)
+        return times
+
+    def expand(self, root, bridge_station, sensor_channels, start_time, end_time, bridge=None):
+        """
+        Expand the template into the sorted list of directories to search.
+        :return: The directories, None if the template is not plannable
+        """
+        if not self.plannable:
+            return None
+
+        times = self.times(start_time, end_time)
+        return sorted(set(self.format(root, bridge_station, sensor_channel, date_time, bridge)
+                          for sensor_channel in sensor_channels
+                          for date_time in times))
+
+# EOF
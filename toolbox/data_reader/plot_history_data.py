@@ -1,23 +1,100 @@
 # -*- coding: utf-8 -*-
 
-from traits.api import HasTraits, Instance, List, Str, Int, Float
-from traitsui.api import UItem, UCustom, View, Group, TableEditor, ObjectColumn
+import logging
+import threading
+from copy import copy
+
+import numpy as np
+
+from traits.api import HasTraits, Instance, List, Dict, Str, Int, Float, Bool, Any
+from traitsui.api import Item, UItem, UCustom, View, Group, TableEditor, ObjectColumn
 from enable.api import ComponentEditor, KeySpec
-from chaco.api import ArrayDataSource, LinePlot, Plot, LinearMapper, Legend, PlotAxis
+from chaco.api import ArrayDataSource, LinePlot, Plot, Legend, PlotAxis
 from chaco.tools.api import ZoomTool, PanTool
 from chaco.example_support import COLOR_PALETTE
 from chaco.scales_tick_generator import ScalesTickGenerator
 from chaco.scales.api import CalendarScaleSystem, DefaultScale
+from pyface.api import GUI
+from pyface.timer.api import Timer, do_after
 
+from channel_statistics import describe, shared_engine
+from decimation import minmax_envelope
+from live_tail import LiveTail
 from read_history_data import Fields, read_data
+from time_series import same_time, to_seconds
 from timemodule import DateTime
 from legend_highlighter_zoom import LegendHighlighterZoom
 
+logger = logging.getLogger(__name__)
+
+
+class EnvelopeLine(HasTraits):
+    """
+    The LinePlot of one channel drawn from the min/max envelope of its samples in
+    the visible index range, about two points per horizontal pixel. The envelope is
+    computed again when the plot is zoomed, panned or resized, the full-resolution
+    samples stay in index and value, the sources of the plot's ranges.
+    """
+
+    line_plot = Instance(LinePlot)
+
+    # the full-resolution samples, the index is shared by the channels on the same grid
+    index = Instance(ArrayDataSource)
+    value = Instance(ArrayDataSource)
+
+    # (low, high, index, value, full rate) of samples read again for a part of the
+    # index range, drawn instead of the others while the visible range lies in [low, high]
+    detail = Any
+
+    def __init__(self, index, value, **traits):
+        """
+        :param index: The ArrayDataSource of the sorted time of the samples in seconds
+        :param value: The samples
+        :param traits: The traits of the LinePlot, its index_mapper is required
+        """
+        self.index = index
+        self.value = ArrayDataSource(value)
+        self.line_plot = LinePlot(
+            index=ArrayDataSource(index.get_data()[:0], sort_order='ascending'),
+            value=ArrayDataSource(value[:0]),
+            **traits)
+        self.line_plot.index_mapper.on_trait_change(self.refresh, 'updated')
+        self.refresh()
+
+    def _samples(self, low, high):
+        """the samples to draw [low, high] from, the detail if it covers the range"""
+        if self.detail is not None and self.detail[0] <= low and high <= self.detail[1]:
+            return self.detail[2], self.detail[3]
+        return self.index.get_data(), self.value.get_data()
+
+    def needs_detail(self, low, high, width):
+        """whether [low, high] has fewer samples than the pixel columns showing it and may have more"""
+        if self.detail is not None and self.detail[0] <= low and high <= self.detail[1] and self.detail[4]:
+            return False
+        index, _ = self._samples(low, high)
+        first, stop = np.searchsorted(index, [low, high])
+        return stop - first < width
+
+    def set_detail(self, low, high, index, value, full_rate):
+        self.detail = (low, high, index, value, full_rate)
+        self.refresh()
+
+    def refresh(self):
+        mapper = self.line_plot.index_mapper
+        low, high = mapper.range.low, mapper.range.high
+        index, value = self._samples(low, high)
+        index, value = minmax_envelope(index, value, low, high, abs(mapper.high_pos - mapper.low_pos))
+        self.line_plot.index.set_data(index, sort_order='ascending')
+        self.line_plot.value.set_data(value)
+
 
 class SignalPlot(HasTraits):
 
     plot = Instance(Plot)
 
+    # channel -> the EnvelopeLine drawing it
+    lines = Dict(Str, Instance(EnvelopeLine))
+
     traits_view = View(
         UItem('plot', editor=ComponentEditor(bgcolor='white')),
         width=800,
@@ -28,23 +105,42 @@ class SignalPlot(HasTraits):
 
         plot = Plot(title=u'Signal Time History')
 
+        # (time, index in seconds) of the grids of the channels, the channels on the same
+        # grid share the index, which is converted to seconds and bounded by the range once
+        indexes = []
+
         i = 0
 
         for chn in history_data.keys():
 
-            line_plot = LinePlot(
-                index=ArrayDataSource(history_data[chn]['time']/1000.0),
-                value=ArrayDataSource(history_data[chn]['data']),
+            if history_data[chn] is None:
+                # no data file of the channel in the window
+                continue
+            time = history_data[chn]['time']
+            for grid, index in indexes:
+                if same_time(grid, time):
+                    break
+            else:
+                index = ArrayDataSource(to_seconds(time), sort_order='ascending')
+                indexes.append((time, index))
+                # the ranges span the full-resolution samples, not the envelope drawn
+                plot.index_range.sources.append(index)
+
+            # all the lines are mapped by the plot's own mappers
+            line = EnvelopeLine(
+                index,
+                history_data[chn]['data'],
                 color=COLOR_PALETTE[i],
-                index_mapper=LinearMapper(range=plot.index_range),
-                value_mapper=LinearMapper(range=plot.value_range)
+                index_mapper=plot.index_mapper,
+                value_mapper=plot.value_mapper
             )
+            line_plot = line.line_plot
+            self.lines[chn] = line
 
             plot.add(line_plot)
             plot.plots[chn] = [line_plot]
 
-            plot.index_range.sources.append(line_plot.index)
-            plot.value_range.sources.append(line_plot.value)
+            plot.value_range.sources.append(line.value)
 
             i += 1
 
@@ -93,14 +189,32 @@ class SignalPlot(HasTraits):
 
         self.plot = plot
 
+    def update_channel(self, chn, time, data):
+        """replace the samples of a channel, e.g. by the latest ones of a live tail"""
+        line = self.lines[chn]
+        index = to_seconds(time)
+        if any(other is not line and other.index is line.index for other in self.lines.values()):
+            # the channel leaves the grid it shares with others
+            line.index = ArrayDataSource(index, sort_order='ascending')
+            self.plot.index_range.sources.append(line.index)
+        else:
+            line.index.set_data(index, sort_order='ascending')
+        line.value.set_data(data)
+        line.detail = None
+        line.refresh()
+
 
 class SignalInfo(HasTraits):
     channel = Str
     start_time = Str
     end_time = Str
     sample_count = Int
+    nan_count = Int
     maximum = Float
     minimum = Float
+    mean = Float
+    rms = Float
+    std = Float
 
 
 class SignalInfoTable(HasTraits):
@@ -114,44 +228,101 @@ class SignalInfoTable(HasTraits):
                 label=u'通道名称',
                 horizontal_alignment='center',
                 style='custom',
-                width=0.2),
+                width=0.1),
             ObjectColumn(
                 name='start_time',
                 label=u'起始时间',
                 horizontal_alignment='center',
                 style='custom',
-                width=0.3),
+                width=0.15),
             ObjectColumn(
                 name='end_time',
                 label=u'结束时间',
                 horizontal_alignment='center',
                 style='custom',
-                width=0.3),
+                width=0.15),
             ObjectColumn(
                 name='sample_count',
                 label=u'采样点数',
                 horizontal_alignment='center',
                 style='custom',
-                width=0.2)],
+                width=0.1),
+            ObjectColumn(
+                name='nan_count',
+                label=u'缺失点数',
+                horizontal_alignment='center',
+                style='custom',
+                width=0.1),
+            ObjectColumn(
+                name='minimum',
+                label=u'最小值',
+                horizontal_alignment='center',
+                style='custom',
+                format='%.4g',
+                width=0.08),
+            ObjectColumn(
+                name='maximum',
+                label=u'最大值',
+                horizontal_alignment='center',
+                style='custom',
+                format='%.4g',
+                width=0.08),
+            ObjectColumn(
+                name='mean',
+                label=u'均值',
+                horizontal_alignment='center',
+                style='custom',
+                format='%.4g',
+                width=0.08),
+            ObjectColumn(
+                name='rms',
+                label=u'均方根',
+                horizontal_alignment='center',
+                style='custom',
+                format='%.4g',
+                width=0.08),
+            ObjectColumn(
+                name='std',
+                label=u'标准差',
+                horizontal_alignment='center',
+                style='custom',
+                format='%.4g',
+                width=0.08)],
         editable=False, sortable=True, row_factory=SignalInfo)
 
     traits_view = View(
         Group(UItem('signal_info_list', editor=table_editor)),
         width=800, height=150, resizable=True)
 
-    def __init__(self, history_data):
+    def __init__(self, history_data, engine=None):
+        """
+        :param engine: The StatisticsEngine caching the statistics of the channels, the process-wide one by default
+        """
+        engine = engine if engine is not None else shared_engine()
 
         self.signal_info_list = []
         for channel in history_data.keys():
+            if history_data[channel] is None:
+                # no data file of the channel in the window
+                continue
+            # one NaN-aware pass over the blocks not computed for an earlier window
+            statistics = describe(engine.statistics(channel, history_data[channel]))
             signal_info = SignalInfo()
             signal_info.channel = channel
-            signal_info.sample_count = history_data[channel]['time'].__len__()
-            signal_info.start_time = DateTime.fromtimestamp(history_data[channel]['time'][0]/1000) \
-                .strftime('%Y-%m-%d %H:%M:%S')
-            signal_info.end_time = DateTime.fromtimestamp(history_data[channel]['time'][-1]/1000) \
-                .strftime('%Y-%m-%d %H:%M:%S')
-            signal_info.maximum = history_data[channel]['data'].max()
-            signal_info.minimum = history_data[channel]['data'].min()
+            signal_info.sample_count = statistics['count']
+            signal_info.nan_count = statistics['nan_count']
+            # the first and the last sample from the coverage, the samples needn't be put together,
+            # the times are left blank when the files of the channel have no sample in the window
+            extent = history_data[channel].extent()
+            if extent is not None:
+                start_time, end_time = extent
+                signal_info.start_time = DateTime.fromtimestamp(start_time/1000).strftime('%Y-%m-%d %H:%M:%S')
+                signal_info.end_time = DateTime.fromtimestamp(end_time/1000).strftime('%Y-%m-%d %H:%M:%S')
+            signal_info.maximum = statistics['max']
+            signal_info.minimum = statistics['min']
+            signal_info.mean = statistics['mean']
+            signal_info.rms = statistics['rms']
+            signal_info.std = statistics['std']
 
             self.signal_info_list.append(signal_info)
 
@@ -161,14 +332,153 @@ class DataFigure(HasTraits):
     signal_plot = Instance(SignalPlot)
     signal_info_table = Instance(SignalInfoTable)
 
+    # read the visible span again at the resolution of the plot when it is zoomed or panned
+    reload_on_zoom = Bool(False)
+
+    # the milliseconds the index range has to stay unchanged before the visible span is read
+    reload_delay = Int(300)
+
+    # the search fields the data have been read with, and the catalog and the cache to read them again
+    fields = Instance(Fields)
+    catalog = Any
+    cache = Any
+
+    # append the samples written to the channels' current data files to the plot as they come in
+    live = Bool(False)
+
+    # the samples kept per channel and the most refreshes of the plot per second in live mode
+    live_capacity = Int(360000)
+    refresh_rate = Float(2.0)
+
+    # the LiveTail of the channels while live
+    live_tail = Any
+
+    # why the latest read of the visible span failed, empty once a read has been swapped in
+    read_error = Str
+
     traits_view = View(
-        UCustom('signal_plot'), UCustom('signal_info_table')
+        UCustom('signal_plot'), UCustom('signal_info_table'),
+        Item('live', label=u'实时数据', enabled_when='fields is not None'),
+        Item('read_error', label=u'读取失败', style='readonly', visible_when='read_error')
     )
 
-    def __init__(self, data):
+    def __init__(self, data, fields=None, catalog=None, cache=None, reload_on_zoom=False):
         self.signal_plot = SignalPlot(data)
         self.signal_info_table = SignalInfoTable(data)
 
+        self.fields = fields
+        self.catalog = catalog
+        self.cache = cache
+        self.reload_on_zoom = reload_on_zoom and fields is not None
+
+        # the generation of the latest change of the index range and of the latest read swapped in,
+        # a read is only started when the range hasn't changed for reload_delay milliseconds
+        self._generation = 0
+        self._swapped = 0
+
+        # the latest (generation, fields, max_points) to read, a request the reader thread
+        # hasn't taken yet is replaced by a later one and never read
+        self._request = None
+        self._request_ready = threading.Condition()
+        self._reader = None
+        self.signal_plot.plot.index_range.on_trait_change(self._index_range_updated, 'updated')
+
+    def _live_changed(self, live):
+        if live:
+            self.live_tail = LiveTail(self.fields, self.live_capacity)
+            self.live_tail.start()
+            self._live_versions = {}
+            self._live_timer = Timer(int(1000 / self.refresh_rate), self._refresh_live)
+        elif self.live_tail is not None:
+            self._live_timer.Stop()
+            self.live_tail.stop()
+            self.live_tail = None
+
+    def _refresh_live(self):
+        """put the snapshots of the channels that got new samples into the plot, on the GUI thread"""
+        if self.live_tail.error is not None:
+            logger.error(u'live mode stopped: %s', self.live_tail.error)
+            self.live = False
+            return
+        for chn, ring_buffer in self.live_tail.buffers.items():
+            if chn not in self.signal_plot.lines or ring_buffer.version == self._live_versions.get(chn):
+                continue
+            self._live_versions[chn] = ring_buffer.version
+            series = ring_buffer.values()
+            self.signal_plot.update_channel(chn, series.time, series.data)
+
+    def _index_range_updated(self):
+        if not self.reload_on_zoom:
+            return
+        self._generation += 1
+        do_after(self.reload_delay, self._reload, self._generation)
+
+    def _reload(self, generation):
+        """start reading the visible span in the background if it has changed no more"""
+        if generation != self._generation:
+            return
+        plot = self.signal_plot.plot
+        low, high = plot.index_range.low, plot.index_range.high
+        width = int(abs(plot.index_mapper.high_pos - plot.index_mapper.low_pos))
+        channels = [chn for chn, line in self.signal_plot.lines.items() if line.needs_detail(low, high, width)]
+        if not channels or high <= low:
+            return
+
+        # half the span is read on each side so short pans are drawn from the same read,
+        # the window starts on a whole second like the data files do
+        span = high - low
+        fields = copy(self.fields)
+        fields.sensor_channel = channels
+        fields.start_time = DateTime.fromtimestamp(np.floor(low - span / 2))
+        fields.end_time = DateTime.fromtimestamp(np.ceil(high + span / 2))
+        max_points = 4 * max(width, 1)
+
+        with self._request_ready:
+            self._request = (generation, fields, max_points)
+            self._request_ready.notify()
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read)
+                self._reader.daemon = True
+                self._reader.start()
+
+    def _read(self):
+        """read the latest span requested at the resolution of the plot, then swap it in on the GUI thread"""
+        while True:
+            with self._request_ready:
+                while self._request is None:
+                    self._request_ready.wait()
+                generation, fields, max_points = self._request
+                self._request = None
+
+            try:
+                data = read_data(fields, self.catalog, cache=self.cache, max_points=max_points, method='minmax')
+            except Exception as error:
+                logger.exception(u'reading %s to %s failed', fields.start_time, fields.end_time)
+                GUI.invoke_later(self._read_failed, generation, error)
+                continue
+            GUI.invoke_later(self._swap, generation, fields, data, max_points)
+
+    def _read_failed(self, generation, error):
+        # the plot keeps what it shows, a later read may succeed
+        if generation < self._swapped:
+            return
+        self.read_error = unicode(error)
+
+    def _swap(self, generation, fields, data, max_points):
+        # a read started before the one swapped in last is outdated
+        if generation < self._swapped:
+            return
+        self._swapped = generation
+        self.read_error = u''
+
+        low, high = fields.start_time.timestamp('S'), fields.end_time.timestamp('S')
+        for chn, series in data.items():
+            if series is None or chn not in self.signal_plot.lines:
+                continue
+            # channels the reader didn't decimate are at their full rate
+            self.signal_plot.lines[chn].set_detail(
+                low, high, to_seconds(series['time']), series['data'], 2 * len(series.time) <= max_points)
+
 
 if __name__ == '__main__':
 
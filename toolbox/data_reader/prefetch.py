@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+Background prefetch of the time windows adjacent to the one being read.
+
+When the timeline is panned every new window would be a cold read. After each
+read the prefetcher predicts the next windows (the same channels, shifted by
+the window's duration in the direction of the last move first), and a
+background thread finds their data files and decodes them into a BlockCache.
+A later read of such a window is served from the cache, a read of a block
+still being prefetched waits for that decoding instead of starting its own.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import logging
+import threading
+from copy import copy
+
+from block_cache import shared_cache
+from data_file import DataFileYS, to_timestamp
+from read_history_data import find_data_files, read_data
+from timemodule import DateTime
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    """
+    Read windows through read_data and prefetch the adjacent ones.
+
+    Example:
+
+    prefetcher = Prefetcher(catalog=DataCatalog(r'e:\MelakBridge\HistoryData'))
+    history_data = prefetcher.read(fields)
+    fields.start_time, fields.end_time = fields.end_time, '2015-09-01 04:00:00'
+    history_data = prefetcher.read(fields)  # decoded in the background meanwhile
+    """
+
+    def __init__(self, cache=None, catalog=None, windows=1, max_bytes=None):
+        """
+        :param cache: The BlockCache the windows are prefetched into, the process-wide one by default
+        :param catalog: The DataCatalog to find the data files in, optional
+        :param windows: The number of windows prefetched on each side of the window read
+        :param max_bytes: The most decoded bytes prefetched after a read, half the cache's budget
+            by default so the prefetched windows never evict the window being looked at
+        """
+        self.cache = cache if cache is not None else shared_cache()
+        self.catalog = catalog
+        self.windows = windows
+        self.max_bytes = self.cache.max_bytes // 2 if max_bytes is None else max_bytes
+
+        # (start, end) timestamps of the last window read
+        self._last_window = None
+
+        # (generation, fields) of the windows to prefetch, a read increments
+        # the generation and so cancels the prefetch of the previous one
+        self._pending = []
+        self._generation = 0
+        # the bytes prefetched for the windows of the current generation
+        self._prefetched_bytes = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def predict(self, start, end):
+        """the [start, end) timestamps of the windows to prefetch, most likely first"""
+        duration = end - start
+        backward = self._last_window is not None and start < self._last_window[0]
+        windows = []
+        for count in range(1, self.windows + 1):
+            forward_window = (start + count * duration, end + count * duration)
+            backward_window = (start - count * duration, end - count * duration)
+            windows.extend([backward_window, forward_window] if backward else [forward_window, backward_window])
+        return windows
+
+    def cancel(self):
+        """drop the prefetch not started yet, the file being decoded is finished"""
+        with self._condition:
+            self._generation += 1
+            self._pending = []
+            self._prefetched_bytes = 0
+
+    def read(self, fields, workers=1):
+        """read_data through the cache, then prefetch the windows adjacent to fields' window"""
+        self.cancel()
+        history_data = read_data(fields, self.catalog, workers, self.cache)
+        self.schedule(fields)
+        return history_data
+
+    def schedule(self, fields):
+        """queue the windows predicted from fields' window, their files are found on the background thread"""
+        start, end = to_timestamp(fields.start_time), to_timestamp(fields.end_time)
+        pending = []
+        for window_start, window_end in self.predict(start, end):
+            window_fields = copy(fields)
+            window_fields.start_time = DateTime.fromtimestamp(window_start / 1000.0)
+            window_fields.end_time = DateTime.fromtimestamp(window_end / 1000.0)
+            pending.append(window_fields)
+        self._last_window = (start, end)
+
+        with self._condition:
+            self._pending = [(self._generation, window_fields) for window_fields in pending]
+            self._condition.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _prefetch(self, generation, fields):
+        """decode the data files of a window while it is current and within the budget"""
+        start, end = to_timestamp(fields.start_time), to_timestamp(fields.end_time)
+        for data_file in find_data_files(fields, self.catalog):
+            if isinstance(data_file, DataFileYS):
+                continue
+            first, stop = data_file.window(start, end)
+            with self._condition:
+                if generation != self._generation:
+                    return
+                self._prefetched_bytes += (stop - first) * 4
+                if self._prefetched_bytes > self.max_bytes:
+                    return
+            if not self.cache.contains(data_file, first, stop):
+                self.cache.samples(data_file, first, stop)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                generation, fields = self._pending.pop(0)
+                if generation != self._generation:
+                    continue
+
+            try:
+                self._prefetch(generation, fields)
+            except Exception:
+                # a file has been moved or is being written, or a decoder failed: the foreground
+                # read will tell, the thread keeps serving the next windows
+                logger.exception('prefetching %s to %s failed', fields.start_time, fields.end_time)
+                continue
+
+# EOF
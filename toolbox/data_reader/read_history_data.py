@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
 
-from os.path import join, isdir
+from os.path import join, isdir, dirname
+import logging
 import os
+import threading
+from Queue import Queue, Full
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
-import pylab as plt
 
-from data_file import create_data_file
+from data_file import DataFileYS, parse_directory, to_timestamp
+from decimation import Decimator, decimation_factor
+from path_template import PathTemplate, normalize_path
+from time_series import RegularTimeIndex, SegmentedSeries
 from timemodule import DateTime, create_date_time
 
+logger = logging.getLogger(__name__)
+
 
 class Fields(object):
     """搜索文件的条件"""
@@ -17,6 +26,7 @@ class Fields(object):
         # self._root =
         self._path = r'{root}\{datetime:%Y%m%d}\{sensor_channel}'
         self._bridge_station = ''
+        self._bridge = None
         self._sensor_channel = []
         self._start_time = DateTime.fromtimestamp(0)
         self._end_time = DateTime.fromtimestamp(0)
@@ -45,6 +55,19 @@ class Fields(object):
         else:
             raise ValueError('Invalid assignment to bridge_station field: strings required')
 
+    @property
+    def bridge(self):
+        # the bridge's name, it only fills in the {bridge} field of the path template
+        # while the files are selected by bridge_station, the bridge station by default
+        return self._bridge_station if self._bridge is None else self._bridge
+
+    @bridge.setter
+    def bridge(self, value):
+        if isinstance(value, basestring):
+            self._bridge = value
+        else:
+            raise ValueError('Invalid assignment to bridge field: strings required')
+
     @property
     def sensor_channel(self):
         return self._sensor_channel
@@ -90,6 +113,7 @@ class Fields(object):
         return {sensor_channel: self.path.format(
             root=self.root,
             bridge_station=self.bridge_station,
+            bridge=self.bridge,
             sensor_channel=sensor_channel,
             datetime=self.start_time)
             for sensor_channel in self.sensor_channel}
@@ -99,28 +123,47 @@ class Fields(object):
         return {sensor_channel: self.path.format(
             root=self.root,
             bridge_station=self.bridge_station,
+            bridge=self.bridge,
             sensor_channel=sensor_channel,
             datetime=self.end_time)
             for sensor_channel in self.sensor_channel}
 
+    def plan_directories(self):
+        """the directories that may contain the data files wanted, some of them may not
+        exist. None when the path template can not be planned and the whole root has to
+        be searched."""
+        directories, _ = self._planned_prefixes()
+        return directories
+
+    def _planned_prefixes(self):
+        key = (self.root, self.path, self.bridge_station, self.bridge, tuple(self.sensor_channel),
+               self.start_time, self.end_time)
+        if getattr(self, '_prefixes_key', None) != key:
+            directories = PathTemplate(self.path).expand(
+                self.root, self.bridge_station, self.sensor_channel, self.start_time, self.end_time,
+                self.bridge)
+            if directories is None:
+                prefixes = None
+            else:
+                prefixes = set()
+                for directory in directories:
+                    while directory not in prefixes:
+                        prefixes.add(directory)
+                        directory = dirname(directory)
+            self._prefixes_key, self._prefixes = key, (directories, prefixes)
+        return self._prefixes
+
     def compare_path(self, path):
-        """compare the three paths，return true if each component of "path" was under
-        the constraint of the corresponding component of "start_path" and "end_path". """
-
-        # for sensor_channel in self.sensor_channel:
-        #
-        #     path_components = path.split(os.sep)
-        #     start_path_components = self.start_path[sensor_channel].split(os.sep)
-        #     end_path_components = self.end_path[sensor_channel].split(os.sep)
-        #
-        #     path_component_under_constraint = \
-        #         [start_path_components[i] <= path_components[i] <= end_path_components[i]
-        #          for i in range(len(path_components))]
-        #     if all(path_component_under_constraint):
-        #         return True
-        # else:
-        #     return False
-        return True
+        """return true if "path" leads to or lies in one of the directories the path
+        template expands to with the search conditions."""
+        directories, prefixes = self._planned_prefixes()
+        if directories is None:
+            return True
+
+        path = normalize_path(path)
+        if path in prefixes:
+            return True
+        return any(path.startswith(directory + os.sep) for directory in directories)
 
     def compare_file(self, data_file):
         if data_file.sensor_channel not in self.sensor_channel:
@@ -135,67 +178,296 @@ class Fields(object):
 
 
 class HistoryData(object):
-    def __init__(self, fields):
-        self.start_time = fields.start_time
-        self.end_time = fields.end_time
+    def __init__(self, fields, cache=None, start_time=None, end_time=None,
+                 target_rate=None, max_points=None, method='mean', chunk=None):
+        # the window defaults to the one of fields, DateTime objects or timestamps
+        self.start_time = fields.start_time if start_time is None else start_time
+        self.end_time = fields.end_time if end_time is None else end_time
+        self.cache = cache
+        # (start, end) timestamps of a chunk of the window, the series then only hold
+        # the samples of the window's grid inside the chunk
+        self.chunk = chunk
+        # the channels are decimated while they are read when a rate or a number of points is given
+        self.target_rate = target_rate
+        self.max_points = max_points
+        self.method = method
         self.history_data = {sensor_channel: None for sensor_channel in fields.sensor_channel}
 
-    def update(self, data_file):
-
+    def allocate(self, data_file):
+        """create the segmented series (or the Decimator) of the data file's channel if there is none yet"""
         if self.history_data[data_file.sensor_channel] is None:
-            time = np.arange(self.start_time.timestamp(),
-                             self.end_time.timestamp(),
-                             data_file.dt(), dtype='>u8')
-            self.history_data[data_file.sensor_channel] = np.empty(
-                time.size, dtype=[('time', '>u8'), ('data', '>f4')])
-            self.history_data[data_file.sensor_channel]['time'] = time
-            self.history_data[data_file.sensor_channel]['data'].fill(np.NaN)
+            start = to_timestamp(self.start_time)
+            first, stop = self.grid(data_file.dt())
+            size = stop - first
+            time = RegularTimeIndex(start + first * data_file.dt(), data_file.dt(), size)
+
+            factor = 1
+            if (self.target_rate or self.max_points) and not isinstance(data_file, DataFileYS):
+                factor = decimation_factor(data_file.dt(), size, self.target_rate, self.max_points, self.method)
+            if factor > 1:
+                self.history_data[data_file.sensor_channel] = Decimator(time, factor, self.method)
+            else:
+                self.history_data[data_file.sensor_channel] = SegmentedSeries(time)
+
+    def grid(self, dt):
+        """the samples [first, stop) of the window's grid, start_time + k * dt, the series hold"""
+        start, end = to_timestamp(self.start_time), to_timestamp(self.end_time)
+        size = max(0, int(np.ceil((end - start) / dt)))
+        if self.chunk is None:
+            return 0, size
+
+        def index(time):
+            # the chunks share their bounds, so the tolerance for the rounding errors
+            # of the timestamps only has to be the same for all of them
+            return min(max(int(np.ceil((time - start) / dt - 1e-3)), 0), size)
+        chunk_start, chunk_end = self.chunk
+        return index(chunk_start), size if chunk_end >= end else index(chunk_end)
 
-        time_data = data_file.read()
-        # FIXME debug info
-        print time_data
+    def update(self, data_file):
+        """read the data file as a segment of its channel's series, the series must
+        have been allocated before when data files are read from several threads."""
+        self.allocate(data_file)
+
+        channel_data = self.history_data[data_file.sensor_channel]
+        # the version of the file read, what is cached of the channel's samples is kept until it changes
+        channel_data.add_source((data_file.source, data_file.file_name), data_file.stat(),
+                                data_file.start_timestamp, data_file.end_timestamp)
+        if isinstance(channel_data, Decimator):
+            # the file is read block by block straight into the bins
+            channel_data.add_file(data_file, self.cache)
+            return
+
+        # only the part of the file inside the window is read
+        start_time, end_time = self.start_time, self.end_time
+        first, stop = self.grid(data_file.dt())
+        if self.chunk is not None:
+            # the samples rounded to the grid samples of the chunk, as they are when the window is read at once
+            start = to_timestamp(self.start_time)
+            start_time = max(start, start + (first - 0.5) * data_file.dt())
+            end_time = min(to_timestamp(self.end_time), start + (stop - 0.5) * data_file.dt())
+        time_data = data_file.read(start_time, end_time, self.cache)
+        logger.debug('%d samples read from %s', len(time_data), data_file.file_name)
+        if len(time_data) == 0:
+            return
+
+        start_index = int(round((time_data['time'][0] - to_timestamp(self.start_time)) / data_file.dt())) - first
+        stop_index = min(start_index + len(time_data), channel_data.time.size)
+        channel_data.add(start_index, np.array(time_data['data'][0: stop_index - start_index], dtype=np.float32))
+
+    def finish(self):
+        """the history data with the bins of the decimated channels turned into their series"""
+        for sensor_channel, channel_data in self.history_data.items():
+            if isinstance(channel_data, Decimator):
+                self.history_data[sensor_channel] = channel_data.series()
+        return self.history_data
+
+
+def find_data_files(fields, catalog=None):
+    """
+    find the data files according to the information given in 'fields', in the catalog
+    if one is given or else in the directories planned from the path template.
+    """
+    directories = fields.plan_directories()
+
+    if catalog is not None:
+        # the directories are walked again only once the catalog's refresh of them is older than its max_age
+        catalog.refresh_stale(directories)
+        return catalog.query(fields.sensor_channel, fields.start_time, fields.end_time, fields.bridge_station)
 
-        if data_file.start_time < self.start_time:
-            time_data = time_data[time_data['time'] >= self.start_time.timestamp()]
-        if data_file.end_time > self.end_time:
-            time_data = time_data[time_data['time'] < self.end_time.timestamp()]
+    data_files = []
+    for directory in (directories if directories is not None else [fields.root]):
+        for sup_dir, sub_dirs, sub_files in os.walk(directory):
+            irrelevant_dirs = \
+                [sub_dir for sub_dir in sub_dirs if not fields.compare_path(join(sup_dir, sub_dir))]
+            for irrelevant_dir in irrelevant_dirs:
+                sub_dirs.remove(irrelevant_dir)
 
-        start_index = int((time_data['time'][0] - self.start_time.timestamp()) / data_file.dt())
-        self.history_data[data_file.sensor_channel][start_index: start_index + len(time_data)] = time_data
+            for data_file in parse_directory(sub_files, sup_dir):
+                if fields.compare_file(data_file) is True:
+                    logger.debug('found %s', data_file.file_name)
+                    data_files.append(data_file)
+    return data_files
 
 
-def read_data(fields):
+def read_data(fields, catalog=None, workers=1, cache=None, target_rate=None, max_points=None, method='mean'):
     """
     find and read data files according to the information given in 'fields'.
 
         Syntax:: history_data = read_history_data(fields)
         Input:: fields
             An instance of Class Fields
+        Input:: catalog
+            An instance of Class DataCatalog built on fields.root, optional. When given,
+            the data files are looked up in the catalog instead of walking the root.
+        Input:: workers
+            The number of threads reading data files at the same time, each
+            (channel, file) pair is one task of the thread pool.
+        Input:: cache
+            Any object with a samples(data_file, first, stop) method, optional, e.g. a
+            BlockCache or a NativeCache. When given, the samples are served from it.
+        Input:: target_rate
+            The rate in Hz to decimate the channels to while they are read, optional.
+            Each data file is read in blocks that are reduced to their bins right
+            away, the full-rate samples are never held in memory.
+        Input:: max_points
+            The most points per channel in the window, optional, decimates like target_rate.
+        Input:: method
+            How the samples of a bin are reduced: 'mean', 'minmax' (the min and max of
+            every bin, interleaved) or 'decimate' (anti-aliased decimation).
         Output:: history_data
-            The history_data component of Class HistoryData
+            The history_data component of Class HistoryData, a dict of channel -> SegmentedSeries
+            (None for channels without data files), call densify() on a series to get the
+            whole window with NaN in the gaps.
     """
 
-    history_data = HistoryData(fields)
-
-    for sup_dir, sub_dirs, sub_files in os.walk(fields.root):
-        irrelevant_dirs = \
-            [sub_dir for sub_dir in sub_dirs if not fields.compare_path(join(sup_dir, sub_dir))]
-        for irrelevant_dir in irrelevant_dirs:
-            sub_dirs.remove(irrelevant_dir)
-
-        for file_name in sub_files:
-            data_file = create_data_file(sup_dir, file_name)
-            if data_file is not None and fields.compare_file(data_file) is True:
-                # FIXME debug info
-                print data_file.file_name
-                history_data.update(data_file)
-
-    return history_data.history_data
+    history_data = HistoryData(fields, cache, target_rate=target_rate, max_points=max_points, method=method)
+    data_files = find_data_files(fields, catalog)
+
+    if workers <= 1 or len(data_files) <= 1:
+        for data_file in data_files:
+            history_data.update(data_file)
+        return history_data.finish()
+
+    # the series are allocated up front, the threads then only add segments to them
+    for data_file in data_files:
+        history_data.allocate(data_file)
+
+    pool = ThreadPool(min(workers, len(data_files)))
+    try:
+        pool.map(history_data.update, data_files, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return history_data.finish()
+
+
+def _chunk_duration(duration):
+    if isinstance(duration, timedelta):
+        return duration.total_seconds() * 1000.0
+    return float(duration)
+
+
+def _iter_chunks(fields, duration, size, aligned, catalog, cache):
+    data_files = {sensor_channel: [] for sensor_channel in fields.sensor_channel}
+    for data_file in find_data_files(fields, catalog):
+        data_files[data_file.sensor_channel].append(data_file)
+    for channel_files in data_files.values():
+        channel_files.sort(key=lambda data_file: data_file.start_timestamp)
+
+    # chunk duration of each channel, channels without data files are left out
+    durations = {}
+    for sensor_channel, channel_files in data_files.items():
+        if channel_files:
+            durations[sensor_channel] = _chunk_duration(duration) if duration is not None \
+                else size * channel_files[0].dt()
+    if aligned and len(set(durations.values())) > 1:
+        raise ValueError('Channels sampled at different rates can only be aligned in fixed-duration chunks')
+
+    def read_chunk(sensor_channels, chunk_start, chunk_end):
+        # the chunks are placed on the grid of the whole window, so they join up to what read_data returns
+        history_data = HistoryData(fields, cache, start, end, chunk=(chunk_start, chunk_end))
+        for sensor_channel in sensor_channels:
+            channel_files = data_files[sensor_channel]
+            history_data.allocate(channel_files[0])
+            for data_file in channel_files:
+                # samples up to half a period before the chunk are rounded into it
+                if data_file.start_timestamp < chunk_end and \
+                        data_file.end_timestamp + data_file.dt() > chunk_start:
+                    history_data.update(data_file)
+        return history_data.history_data
+
+    start, end = to_timestamp(fields.start_time), to_timestamp(fields.end_time)
+    if aligned:
+        if not durations:
+            return
+        chunk_duration = durations.values()[0]
+        chunk_start = start
+        while chunk_start < end:
+            chunk_end = min(chunk_start + chunk_duration, end)
+            yield chunk_start, read_chunk(durations.keys(), chunk_start, chunk_end)
+            chunk_start = chunk_end
+    else:
+        for sensor_channel in fields.sensor_channel:
+            if sensor_channel not in durations:
+                continue
+            chunk_start = start
+            while chunk_start < end:
+                chunk_end = min(chunk_start + durations[sensor_channel], end)
+                yield sensor_channel, read_chunk([sensor_channel], chunk_start, chunk_end)[sensor_channel]
+                chunk_start = chunk_end
+
+
+def iter_data(fields, duration=None, size=None, aligned=False, read_ahead=2, catalog=None, cache=None):
+    """
+    read the data according to the information given in 'fields' chunk by chunk,
+    so arbitrarily long windows are processed in bounded memory.
+
+        Syntax:: for sensor_channel, series in iter_data(fields, duration=timedelta(hours=1)): ...
+        Input:: duration
+            The duration of the chunks, a timedelta or milliseconds
+        Input:: size
+            The number of samples of the chunks, used when no duration is given
+        Input:: aligned
+            False to yield (channel, series) channel by channel in time order, True to yield
+            (chunk start timestamp, dict of channel -> series) for all the channels at once
+        Input:: read_ahead
+            The number of chunks read in advance on a background thread, 0 to read on demand
+        Output:: chunks
+            The series of the chunks are SegmentedSeries as read_data returns
+    """
+    if duration is None and size is None:
+        raise ValueError('Either the duration or the size of the chunks is required')
+
+    chunks = _iter_chunks(fields, duration, size, aligned, catalog, cache)
+    if read_ahead <= 0:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    queue = Queue(maxsize=read_ahead)
+    stopped = threading.Event()
+    end_of_chunks = object()
+
+    def put(item):
+        # give up when the consumer has stopped iterating and the queue stays full
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for produced in chunks:
+                if not put((produced, None)):
+                    return
+            put((end_of_chunks, None))
+        except Exception as error:
+            put((None, error))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            chunk, error = queue.get()
+            if error is not None:
+                raise error
+            if chunk is end_of_chunks:
+                break
+            yield chunk
+    finally:
+        stopped.set()
+        producer.join()
 
 
 if __name__ == '__main__':
+    import pylab as plt
 
-    # input_dict从界面程序传过来
+    # input_dict从界面程序传过来, 批量导出数据请用extract_cmd.py
     input_dict = {
         'root': r'e:\MelakBridge\HistoryData',  # root和“文件根目录”相对应
         'sensor_channel': ('SEW1111-DX', 'SEW1112-DX'),  # sensor_channel和“传感器通道”相对应
@@ -219,32 +491,4 @@ if __name__ == '__main__':
     plt.show()
     print len(np_history_data[key]['data'])
 
-'''
-    import sys
-    import json
-
-    with open(sys.argv[1], 'r') as json_input_file:
-        input_dict = json.load(json_input_file)
-
-    fields = Fields(**input_dict)
-
-    np_history_data = read_history_data(fields)
-
-    key = fields.sensor_channel[1]
-    print DateTime.fromtimestamp(np_history_data[key]['time'][0] / 1000)
-    print DateTime.fromtimestamp(np_history_data[key]['time'][-1] / 1000)
-    plt.plot(np_history_data[key]['time'], np_history_data[key]['data'])
-    plt.show()
-
-    history_data = dict()
-    for sensor_channel in fields.sensor_channel:
-        history_data[sensor_channel] = dict()
-        history_data[sensor_channel]['time'] = np_history_data[sensor_channel]['time'].tolist()
-        history_data[sensor_channel]['data'] = np_history_data[sensor_channel]['data'].tolist()
-
-    with open(sys.argv[2], 'w') as json_output_file:
-        json.dump(history_data, json_output_file)
-
-        # CMD
-        # python read_history_data.py json_input_file.txt json_output_file.txt
-'''
+# EOF
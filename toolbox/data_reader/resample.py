@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Alignment of channels sampled at different rates onto one time grid.
+
+Every channel read by read_data has its own grid (start, dt). The resamplers
+here bring them onto a common grid block by block: downsampling goes through
+anti-aliased polyphase filtering (scipy.signal.resample_poly), upsampling
+and phase shifts through linear interpolation. Each block is computed with
+enough context around it to give the same result as resampling the whole
+series at once, so arbitrarily long windows are streamed in bounded memory.
+Every run of covered samples is resampled on its own, its edge samples are
+repeated as context for the filter, so a gap only makes the outputs that
+fall inside it NaN.
+"""
+
+# ---- Imports -----------------------------------------------------------
+from fractions import Fraction
+
+import numpy as np
+from scipy.signal import resample_poly
+
+from time_series import RegularTimeIndex, SegmentedSeries
+
+
+class ChannelResampler(object):
+    """resample one channel's series onto the grid start + j * dt"""
+
+    def __init__(self, series, start, dt):
+        self.series = series
+        self.grid = series.time
+        if not isinstance(self.grid, RegularTimeIndex):
+            raise ValueError('only series on a regular time grid can be resampled')
+
+        # output samples per input sample as a reduced fraction up / down
+        ratio = Fraction(repr(self.grid.dt)) / Fraction(repr(float(dt)))
+        self.up, self.down = ratio.numerator, ratio.denominator
+
+        # input position of the output sample 0 and input samples per output sample
+        self.offset = (start - self.grid.start) / self.grid.dt
+        self.step = float(dt) / self.grid.dt
+
+        # input samples the polyphase filter reaches on each side
+        self.context = 10 * max(self.up, self.down) // self.up + 2
+
+        # the [first, stop) input indexes of the runs of covered samples, resampled one by one
+        if isinstance(series, SegmentedSeries):
+            self.runs = series.coverage()
+        else:
+            self.runs = [(0, self.grid.size)] if self.grid.size else []
+
+    def samples(self, first, stop, run):
+        """
+        The input samples [first, stop) of a run of covered samples, the run's edge
+        samples are repeated outside it as filter context.
+        """
+        run_first, run_stop = run
+        inside_first, inside_stop = min(max(first, run_first), run_stop), min(max(stop, run_first), run_stop)
+        if isinstance(self.series, SegmentedSeries):
+            data = self.series.window(inside_first, inside_stop).astype(np.float64)
+        else:
+            data = np.asarray(self.series.data[inside_first:inside_stop], dtype=np.float64)
+        if len(data) == 0:
+            return np.empty(stop - first) * np.NaN
+        return np.pad(data, (inside_first - first, stop - inside_stop), mode='edge')
+
+    def _polyphase(self, first, stop, run):
+        """the outputs [first, stop) of resample_poly of a run on the input grid's phase"""
+        # start the input at a multiple of down, so the outputs fall on whole indexes
+        input_first = ((first * self.down) // self.up - self.context) // self.down * self.down
+        input_stop = -(-(stop * self.down) // self.up) + self.context
+        resampled = resample_poly(self.samples(input_first, input_stop, run), self.up, self.down)
+        output_first = input_first * self.up // self.down
+        return resampled[first - output_first: stop - output_first]
+
+    def block(self, first, stop):
+        """the resampled samples [first, stop) of the output grid, NaN where the channel has no samples"""
+        data = np.empty(stop - first) * np.NaN
+        # the input position of each output sample
+        positions = self.offset + np.arange(first, stop) * self.step
+        for run in self.runs:
+            # the outputs between the run's first and last sample, the gaps around it get none
+            inside = np.flatnonzero((positions >= run[0] - 1e-9) & (positions <= run[1] - 1 + 1e-9))
+            if len(inside) == 0:
+                continue
+            run_first, run_stop = inside[0], inside[-1] + 1
+            data[run_first:run_stop] = self._block(first + run_first, first + run_stop,
+                                                   positions[run_first:run_stop], run)
+        return data
+
+    def _block(self, first, stop, positions, run):
+        if self.up >= self.down:
+            input_first = int(np.floor(positions[0]))
+            input_stop = int(np.floor(positions[-1])) + 2
+            return np.interp(positions, np.arange(input_first, input_stop),
+                             self.samples(input_first, input_stop, run))
+
+        # position of the output grid on the polyphase output's grid
+        shift = self.offset / self.step
+        if shift == np.floor(shift):
+            return self._polyphase(first + int(shift), stop + int(shift), run)
+
+        positions = np.arange(first, stop) + shift
+        polyphase_first = int(np.floor(positions[0]))
+        polyphase_stop = int(np.floor(positions[-1])) + 2
+        return np.interp(positions, np.arange(polyphase_first, polyphase_stop),
+                         self._polyphase(polyphase_first, polyphase_stop, run))
+
+
+def align_channels(history_data, dt, start=None, end=None, block_size=65536):
+    """
+    Resample the channels returned by read_data onto one grid, block by block.
+
+        Syntax:: for time, data in align_channels(history_data, 50.0): ...
+        Input:: history_data
+            A dict of channel -> series on a regular grid, channels without data (None) are left out
+        Input:: dt
+            The interval in milliseconds of the common grid
+        Input:: start, end
+            The window in milliseconds of the common grid, the union of the channels' grids by default
+        Input:: block_size
+            The number of output samples per block
+        Output:: (time, data)
+            The RegularTimeIndex of the block and a dict of channel -> float32 samples
+    """
+    series = {channel: channel_series for channel, channel_series in history_data.items()
+              if channel_series is not None}
+    if not series:
+        return
+
+    if start is None:
+        start = min(channel_series.time.start for channel_series in series.values())
+    if end is None:
+        end = max(channel_series.time.end for channel_series in series.values())
+    size = max(0, int(np.ceil((end - start) / dt)))
+
+    resamplers = {channel: ChannelResampler(channel_series, start, dt)
+                  for channel, channel_series in series.items()}
+
+    for first in xrange(0, size, block_size):
+        stop = min(first + block_size, size)
+        yield RegularTimeIndex(start + first * dt, dt, stop - first), \
+            {channel: resampler.block(first, stop).astype(np.float32)
+             for channel, resampler in resamplers.items()}
+
+# EOF
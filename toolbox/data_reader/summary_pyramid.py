@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+"""
+Multi-resolution summaries of the sensor channels.
+
+For every channel the min, max, mean and count of the samples are kept per
+block at power-of-two decimation levels: a block of level 0 holds base_block
+samples, a block of level n holds base_block * 2**n samples. The summaries
+are built from the data files of the archive, updated incrementally when
+files are added or grow, and saved as .npy files per level, so that a long
+time window can be plotted from a few thousand blocks instead of hundreds
+of millions of samples. The levels are memory-mapped when a pyramid is
+opened, only the blocks a query reads are loaded and a level is copied into
+memory when it is changed.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import glob
+import json
+import os
+import tempfile
+from copy import copy
+from os.path import basename, join, isfile
+
+import numpy as np
+
+from data_file import DataFileYS, to_timestamp
+from decimation import SUMMARY_TYPE, empty_summary, summarize, merge
+from read_history_data import read_data
+from time_series import RegularTimeIndex, TimeSeries
+
+# name of the file keeping the pyramid's parameters and the files it has summarized
+META_FILE_NAME = 'pyramid.json'
+
+
+class ChannelPyramid(object):
+    """the summaries of one channel, stored in their own directory"""
+
+    def __init__(self, directory, base_block=1024, level_count=12):
+        self.directory = directory
+        self.dt = None
+        self.base_block = base_block
+        self.level_count = level_count
+
+        # the absolute index of the first block and the summaries of each level,
+        # block k of level n covers the samples from k * base_block * 2**n on
+        self.offsets = [0] * level_count
+        self.levels = [empty_summary(0) for _ in range(level_count)]
+
+        # file name -> [size, mtime, samples summarized] of the files summarized
+        self.files = {}
+
+        # the files the levels are saved in, a level changed is saved in a new file as
+        # the one it was loaded from may be mapped by other pyramids of the channel
+        self.level_files = [None] * level_count
+
+        if isfile(join(directory, META_FILE_NAME)):
+            self.load()
+
+    def load(self):
+        with open(join(self.directory, META_FILE_NAME), 'r') as meta_file:
+            meta = json.load(meta_file)
+        self.dt = meta['dt']
+        self.base_block = meta['base_block']
+        self.level_count = meta['level_count']
+        self.offsets = meta['offsets']
+        self.files = meta['files']
+        self.level_files = meta.get('level_files', ['level_%02d.npy' % level for level in range(self.level_count)])
+        self.levels = [np.load(join(self.directory, level_file), mmap_mode='r') for level_file in self.level_files]
+
+    def save(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for level, summary in enumerate(self.levels):
+            if isinstance(summary, np.memmap):
+                # unchanged since it was loaded
+                continue
+            # a file of its own, the pyramids that mapped the level before still read the old one
+            handle, level_path = tempfile.mkstemp(suffix='.npy', prefix='level_%02d_' % level, dir=self.directory)
+            with os.fdopen(handle, 'wb') as level_file:
+                np.save(level_file, summary)
+            self.level_files[level] = basename(level_path)
+
+        # the files of the pyramid saved last may be mapped by the pyramids loaded from it
+        meta_path = join(self.directory, META_FILE_NAME)
+        kept = set(self.level_files)
+        if isfile(meta_path):
+            with open(meta_path, 'r') as meta_file:
+                kept.update(json.load(meta_file).get('level_files', []))
+        with open(meta_path, 'w') as meta_file:
+            json.dump({
+                'dt': self.dt,
+                'base_block': self.base_block,
+                'level_count': self.level_count,
+                'offsets': self.offsets,
+                'files': self.files,
+                'level_files': self.level_files,
+            }, meta_file)
+
+        for level_file in glob.glob(join(self.directory, 'level_*.npy')):
+            if basename(level_file) in kept:
+                continue
+            try:
+                os.remove(level_file)
+            except OSError:
+                # still mapped by some pyramid on Windows, a later save removes it
+                pass
+
+    def clear(self):
+        self.dt = None
+        self.offsets = [0] * self.level_count
+        self.levels = [empty_summary(0) for _ in range(self.level_count)]
+        self.files = {}
+
+    def block_duration(self, level):
+        """the duration in milliseconds of a block of the level"""
+        return self.dt * self.base_block * 2 ** level
+
+    def _extend(self, level, first, stop):
+        """make the level cover the blocks [first, stop), in memory"""
+        offset, summary = self.offsets[level], self.levels[level]
+        if isinstance(summary, np.memmap):
+            summary = self.levels[level] = np.array(summary)
+        if len(summary) == 0:
+            offset = first
+        new_offset = min(offset, first)
+        new_stop = max(offset + len(summary), stop)
+        if new_offset == offset and new_stop == offset + len(summary):
+            return
+
+        extended = empty_summary(new_stop - new_offset)
+        extended[offset - new_offset: offset - new_offset + len(summary)] = summary
+        self.offsets[level], self.levels[level] = new_offset, extended
+
+    def add(self, data, first_sample):
+        """
+        Add samples to the summaries.
+        :param data: The samples
+        :param first_sample: The absolute index (timestamp / dt) of the first sample
+        """
+        if len(data) == 0:
+            return
+
+        first_block = first_sample // self.base_block
+        summary = summarize(data, self.base_block, first_sample - first_block * self.base_block)
+        stop_block = first_block + len(summary)
+
+        self._extend(0, first_block, stop_block)
+        start = first_block - self.offsets[0]
+        self.levels[0][start: start + len(summary)] = merge(self.levels[0][start: start + len(summary)], summary)
+
+        # rebuild the blocks of the upper levels covering the changed blocks
+        for level in range(1, self.level_count):
+            first_block, stop_block = first_block // 2, (stop_block + 1) // 2
+            self._extend(level, first_block, stop_block)
+            lower_offset, lower = self.offsets[level - 1], self.levels[level - 1]
+            children = empty_summary(2 * (stop_block - first_block))
+            child_first = max(2 * first_block, lower_offset)
+            child_stop = min(2 * stop_block, lower_offset + len(lower))
+            children[child_first - 2 * first_block: child_stop - 2 * first_block] = \
+                lower[child_first - lower_offset: child_stop - lower_offset]
+            start = first_block - self.offsets[level]
+            self.levels[level][start: start + stop_block - first_block] = merge(children[0::2], children[1::2])
+
+    def update(self, data_file):
+        """
+        Summarize the samples of the data file that haven't been summarized yet.
+        :return: False if the file has been rewritten and the pyramid has to be rebuilt
+        """
+        key = data_file.file_name
+        file_size, file_mtime = data_file.stat()
+        size, mtime, done = self.files.get(key, (0, None, 0))
+        if file_size < size or (file_size == size and mtime is not None and file_mtime != mtime):
+            return False
+
+        if self.dt is None:
+            self.dt = data_file.dt()
+        elif self.dt != data_file.dt():
+            raise ValueError('%s is sampled every %s ms instead of %s ms'
+                             % (data_file.file_name, data_file.dt(), self.dt))
+
+        stop = data_file.sample_count
+        if stop > done:
+            first_sample = int(round(data_file.start_timestamp / self.dt)) + done
+            self.add(data_file.read().data[done: stop], first_sample)
+        self.files[key] = [file_size, file_mtime, stop]
+        return True
+
+    def query(self, start, end, points):
+        """
+        Summaries of the window [start, end) from the coarsest level that still
+        has at least *points* blocks in the window.
+        :return: A TimeSeries with SUMMARY_TYPE data, None if level 0 is too coarse
+        """
+        if self.dt is None:
+            return None
+
+        start, end = to_timestamp(start), to_timestamp(end)
+        for level in reversed(range(self.level_count)):
+            duration = self.block_duration(level)
+            if (end - start) / duration >= points:
+                break
+        else:
+            return None
+
+        first = int(np.floor(start / duration))
+        stop = int(np.ceil(end / duration))
+        offset, summary = self.offsets[level], self.levels[level]
+
+        result = empty_summary(stop - first)
+        inside_first, inside_stop = max(first, offset), min(stop, offset + len(summary))
+        if inside_first < inside_stop:
+            result[inside_first - first: inside_stop - first] = summary[inside_first - offset: inside_stop - offset]
+        return TimeSeries(RegularTimeIndex(first * duration, duration, stop - first), result)
+
+
+class PyramidStore(object):
+    """
+    The summary pyramids of all the channels in a catalog.
+
+    Example:
+
+    store = PyramidStore(r'e:\MelakBridge\Pyramid', DataCatalog(r'e:\MelakBridge\HistoryData'))
+    store.update()
+    summaries = store.query(['SEW1111-DX'], '2015-09-01 00:00:00', '2015-10-01 00:00:00', 2000)
+    """
+
+    def __init__(self, root, catalog, base_block=1024, level_count=12):
+        self.root = root
+        self.catalog = catalog
+        self.base_block = base_block
+        self.level_count = level_count
+
+    def pyramid(self, sensor_channel):
+        return ChannelPyramid(join(self.root, sensor_channel), self.base_block, self.level_count)
+
+    def update(self, sensor_channels=None):
+        """summarize the new and grown data files of the channels, all the channels by default"""
+        if sensor_channels is None:
+            self.catalog.refresh()
+            sensor_channels = self.catalog.sensor_channels()
+        else:
+            # the directories the channels' files are known in, new directories show up once
+            # the catalog's refresh of the tree is older than its max_age
+            self.catalog.refresh(self.catalog.directories(sensor_channels))
+            self.catalog.refresh_stale()
+
+        for sensor_channel in sensor_channels:
+            pyramid = self.pyramid(sensor_channel)
+            data_files = [data_file for data_file in self.catalog.query([sensor_channel], 0, np.inf)
+                          if not isinstance(data_file, DataFileYS)]
+            if not all([pyramid.update(data_file) for data_file in data_files]):
+                # some file has been rewritten, summarize the channel again
+                pyramid.clear()
+                for data_file in data_files:
+                    pyramid.update(data_file)
+            pyramid.save()
+
+    def query(self, sensor_channels, start, end, points):
+        """
+        Summaries of the channels in [start, end) with at least *points* blocks each.
+        :return: A dict of channel -> TimeSeries, None for the channels whose level 0 is too coarse
+        """
+        return {sensor_channel: self.pyramid(sensor_channel).query(start, end, points)
+                for sensor_channel in sensor_channels}
+
+
+def read_summary(fields, points, store):
+    """
+    Give about *points* summaries of every channel in fields, from the coarsest adequate
+    level of the store or, for short windows, from the raw data read by read_data.
+    :return: A dict of channel -> TimeSeries with SUMMARY_TYPE data
+    """
+    summaries = store.query(fields.sensor_channel, fields.start_time, fields.end_time, points)
+
+    raw_channels = [channel for channel, summary in summaries.items() if summary is None]
+    if raw_channels:
+        raw_fields = copy(fields)
+        raw_fields.sensor_channel = raw_channels
+        raw_data = read_data(raw_fields, store.catalog)
+        for channel in raw_channels:
+            if raw_data[channel] is None:
+                continue
+            summary = np.empty(len(raw_data[channel]), dtype=SUMMARY_TYPE)
+            summary['min'] = summary['max'] = summary['mean'] = raw_data[channel]['data']
+            summary['count'] = ~np.isnan(raw_data[channel]['data'])
+            summaries[channel] = TimeSeries(raw_data[channel]['time'], summary)
+
+    return summaries
+
+# EOF
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# ---- Imports -----------------------------------------------------------
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from os.path import join
+
+import numpy as np
+
+from channel_statistics import StatisticsEngine, describe
+from read_history_data import Fields, read_data
+
+
+class StatisticsEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.directory = join(self.root, '20150901', 'SEW1111-DX')
+        os.makedirs(self.directory)
+        self.fields = Fields(root=self.root, path=u'{root}/{datetime:%Y%m%d}/{channel}',
+                             sensor_channel=[u'SEW1111-DX'],
+                             start_time='2015-09-01 00:00:00', end_time='2015-09-01 02:00:00')
+        self.engine = StatisticsEngine(block_size=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_file(self, hour, data, mode='wb'):
+        """write data as the 10 ms samples of the hour's F#D# file, a second later than before"""
+        file_name = join(self.directory, 'SEW1111-DX#F#D#201509010%d0000#10MS#' % hour)
+        mtime = os.stat(file_name).st_mtime + 1 if os.path.exists(file_name) else time.time()
+        with open(file_name, mode) as data_file:
+            np.asarray(data, dtype='>f4').tofile(data_file)
+        os.utime(file_name, (mtime, mtime))
+
+    def statistics(self):
+        history_data = read_data(self.fields)
+        return describe(self.engine.statistics(u'SEW1111-DX', history_data[u'SEW1111-DX']))
+
+    def test_file_grown(self):
+        self.write_file(0, np.ones(50000))
+        self.assertEqual(self.statistics()['count'], 50000)
+
+        self.write_file(0, np.full(50000, 3.0), 'ab')
+        statistics = self.statistics()
+        self.assertEqual(statistics['count'], 100000)
+        self.assertEqual(statistics['max'], 3.0)
+        self.assertAlmostEqual(statistics['mean'], 2.0)
+
+    def test_file_written_again(self):
+        self.write_file(0, np.ones(50000))
+        self.assertEqual(self.statistics()['mean'], 1.0)
+
+        self.write_file(0, np.full(50000, 5.0))
+        self.assertEqual(self.statistics()['mean'], 5.0)
+
+    def test_file_landed_and_gone(self):
+        self.write_file(0, np.ones(360000))
+        self.assertEqual(self.statistics()['nan_count'], 360000)
+
+        self.write_file(1, np.full(360000, 3.0))
+        statistics = self.statistics()
+        self.assertEqual((statistics['count'], statistics['nan_count']), (720000, 0))
+        self.assertAlmostEqual(statistics['mean'], 2.0)
+
+        os.remove(join(self.directory, 'SEW1111-DX#F#D#20150901010000#10MS#'))
+        statistics = self.statistics()
+        self.assertEqual((statistics['count'], statistics['nan_count']), (360000, 360000))
+        self.assertEqual(statistics['mean'], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
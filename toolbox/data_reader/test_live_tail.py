@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# ---- Imports -----------------------------------------------------------
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from os.path import join
+
+import numpy as np
+
+from live_tail import LiveTail, PollingWatcher
+from read_history_data import Fields
+from timemodule import create_date_time
+
+
+class LiveTailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.start = datetime.now().replace(microsecond=0) - timedelta(seconds=30)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_samples(self, directory, count, offset=0):
+        """append count samples to the F#D# file of SEW1111-DX started 30 seconds ago"""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        file_name = 'SEW1111-DX#F#D#%s#10MS#' % self.start.strftime('%Y%m%d%H%M%S')
+        with open(join(directory, file_name), 'ab') as data_file:
+            np.arange(offset, offset + count, dtype='>f4').tofile(data_file)
+
+    def tail(self, path):
+        fields = Fields(root=self.root, path=path, bridge_station=u'1', sensor_channel=[u'SEW1111-DX'])
+        return LiveTail(fields, capacity=100000, watcher=PollingWatcher(0.05), interval=0.05)
+
+    def test_template_aliases(self):
+        directory = join(self.root, '1', self.start.strftime('%Y%m%d'), 'SEW1111-DX')
+        self.write_samples(directory, 100)
+        tail = self.tail(u'{root}/{bridge}/{datetime:%Y%m%d}/{channel}')
+        self.assertIn(directory, tail.directories(create_date_time(self.start)))
+
+        tail.start()
+        try:
+            time.sleep(0.3)
+            self.write_samples(directory, 50, 100)
+            time.sleep(0.3)
+        finally:
+            tail.stop()
+        self.assertIsNone(tail.error)
+        series = tail.buffers[u'SEW1111-DX'].values()
+        np.testing.assert_array_equal(series.data, np.arange(150, dtype=np.float32))
+
+    def test_error_stops_thread(self):
+        tail = self.tail(u'{root}/{station}/{channel}')
+        tail.start()
+        tail._thread.join(2.0)
+        self.assertFalse(tail._thread.is_alive())
+        self.assertIsInstance(tail.error, KeyError)
+        tail.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time series of sensor channels.
+
+The channels are regularly sampled, so instead of keeping a '>u8' timestamp
+beside every sample the time is described by a RegularTimeIndex (start, dt,
+size) and the timestamps are only computed when somebody asks for them.
+"""
+
+# ---- Imports -----------------------------------------------------------
+import threading
+
+import numpy as np
+
+# dtype of the time/data records read_data used to return
+RECORD_TYPE = np.dtype([('time', '>u8'), ('data', '>f4')])
+
+
+class RegularTimeIndex(object):
+    """timestamps start + i * dt (in milliseconds) for i in [0, size)"""
+
+    __slots__ = ('start', 'dt', 'size')
+
+    def __init__(self, start, dt, size):
+        self.start = float(start)
+        self.dt = float(dt)
+        self.size = int(size)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            first, stop, step = item.indices(self.size)
+            return RegularTimeIndex(self.start + first * self.dt, self.dt * step, len(xrange(first, stop, step)))
+
+        if item < 0:
+            item += self.size
+        if not 0 <= item < self.size:
+            raise IndexError('time index out of range')
+        return self.start + item * self.dt
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.values()
+        return self.values().astype(dtype)
+
+    def __div__(self, other):
+        return self.values() / other
+
+    __truediv__ = __div__
+
+    def __repr__(self):
+        return 'RegularTimeIndex(start=%r, dt=%r, size=%r)' % (self.start, self.dt, self.size)
+
+    @property
+    def end(self):
+        """the time after the last sample"""
+        return self.start + self.size * self.dt
+
+    def values(self, dtype='>u8'):
+        """materialize the timestamps in milliseconds"""
+        return (self.start + np.arange(self.size) * self.dt).astype(dtype)
+
+    def seconds(self):
+        """materialize the timestamps in seconds as float64"""
+        return (self.start + np.arange(self.size) * self.dt) / 1000.0
+
+    def locate(self, timestamp):
+        """the index of the first sample not earlier than *timestamp*"""
+        return int(np.ceil((timestamp - self.start) / self.dt))
+
+
+class TimeSeries(object):
+    """
+    Samples of one channel, accessible as series['time'] and series['data']
+    the same way as the time/data records read_data used to return.
+    """
+
+    __slots__ = ('time', 'data')
+
+    def __init__(self, time, data):
+        self.time = time
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, item):
+        if isinstance(item, basestring):
+            if item == 'time':
+                return self.time
+            elif item == 'data':
+                return self.data
+            raise KeyError(item)
+        return TimeSeries(self.time[item], self.data[item])
+
+    def extent(self):
+        """the timestamps of the first and the last sample, None without samples"""
+        if len(self.time) == 0:
+            return None
+        return self.time[0], self.time[-1]
+
+    def to_records(self):
+        """the samples as time/data records"""
+        records = np.empty(len(self.data), dtype=RECORD_TYPE)
+        records['time'] = np.asarray(self.time)
+        records['data'] = self.data
+        return records
+
+
+class SegmentedSeries(object):
+    """
+    Samples of one channel in a time window, kept as the segments covered by
+    data files instead of one NaN-filled array over the whole window.
+
+    series['time'] and series['data'] give the samples from the first covered
+    one to the last, always on the window's RegularTimeIndex, with NaN in the
+    gaps between segments so plots break the line there. densify() gives the
+    whole window with NaN in the gaps.
+    """
+
+    def __init__(self, time):
+        # the grid of the whole window
+        self.time = time
+
+        # (first index in the window, data) in the order they were added
+        self.segments = []
+
+        # the data files the segments come from, file key -> (version, start, end), see add_source()
+        self.sources = {}
+
+        self._lock = threading.Lock()
+        self._compact = None
+
+    def __len__(self):
+        return len(self.compact())
+
+    def __getitem__(self, item):
+        return self.compact()[item]
+
+    def add(self, first, data):
+        """add the samples of data as the window's samples from index *first* on"""
+        if len(data) == 0:
+            return
+        with self._lock:
+            self.segments.append((first, data))
+            self._compact = None
+
+    def add_source(self, key, version, start, end):
+        """
+        Record a data file the samples come from, so that what is derived from them
+        can tell when the file has changed since.
+        :param version: The (size, mtime) of the file when it was read
+        :param start: The timestamps [start, end) of the file's samples
+        """
+        with self._lock:
+            self.sources[key] = (version, start, end)
+
+    def coverage(self):
+        """the sorted, merged [first, stop) index ranges covered by the segments"""
+        ranges = []
+        for first, data in sorted(self.segments, key=lambda segment: segment[0]):
+            stop = first + len(data)
+            if ranges and first <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], stop)
+            else:
+                ranges.append([first, stop])
+        return [tuple(covered) for covered in ranges]
+
+    def gaps(self):
+        """the [start, end) timestamps of the parts of the window without data"""
+        gaps = []
+        previous_stop = 0
+        for first, stop in self.coverage() + [(self.time.size, self.time.size)]:
+            if first > previous_stop:
+                gaps.append((self.time.start + previous_stop * self.time.dt, self.time.start + first * self.time.dt))
+            previous_stop = stop
+        return gaps
+
+    def extent(self):
+        """the timestamps of the first and the last covered sample, None without samples"""
+        coverage = self.coverage()
+        if not coverage:
+            return None
+        return self.time.start + coverage[0][0] * self.time.dt, self.time.start + (coverage[-1][1] - 1) * self.time.dt
+
+    def _fill(self, data, first, stop):
+        """put the samples of the window's [first, stop) into data, later segments win"""
+        for segment_first, segment_data in self.segments:
+            overlap_first, overlap_stop = max(first, segment_first), min(stop, segment_first + len(segment_data))
+            if overlap_first < overlap_stop:
+                data[overlap_first - first: overlap_stop - first] = \
+                    segment_data[overlap_first - segment_first: overlap_stop - segment_first]
+
+    def compact(self):
+        """the samples from the first covered to the last as a TimeSeries, NaN in the gaps between segments"""
+        with self._lock:
+            if self._compact is not None:
+                return self._compact
+
+            coverage = self.coverage()
+            if not coverage:
+                self._compact = TimeSeries(self.time[0:0], np.empty(0, dtype=np.float32))
+                return self._compact
+
+            first, stop = coverage[0][0], coverage[-1][1]
+            matching = [data for segment_first, data in self.segments
+                        if segment_first == first and len(data) == stop - first]
+            if matching:
+                # one segment covers it all, its samples are not copied
+                data = matching[-1]
+            else:
+                data = np.empty(stop - first, dtype=np.float32)
+                data.fill(np.NaN)
+                self._fill(data, first, stop)
+            self._compact = TimeSeries(self.time[first:stop], data)
+            return self._compact
+
+    def window(self, first, stop):
+        """the samples of the window's [first, stop) as a float32 array with NaN in the gaps"""
+        data = np.empty(stop - first, dtype=np.float32)
+        data.fill(np.NaN)
+        with self._lock:
+            self._fill(data, first, stop)
+        return data
+
+    def densify(self):
+        """the whole window as a TimeSeries with NaN in the gaps, as read_data used to return"""
+        return TimeSeries(self.time, self.window(0, self.time.size))
+
+
+def same_time(first, second):
+    """whether two RegularTimeIndex or arrays of timestamps give the same times"""
+    if isinstance(first, RegularTimeIndex) or isinstance(second, RegularTimeIndex):
+        return isinstance(first, RegularTimeIndex) and isinstance(second, RegularTimeIndex) and \
+            (first.start, first.dt, first.size) == (second.start, second.dt, second.size)
+    return first is second or (len(first) == len(second) and np.array_equal(first, second))
+
+
+def to_seconds(time):
+    """timestamps in seconds of a RegularTimeIndex or an array of milliseconds"""
+    if isinstance(time, RegularTimeIndex):
+        return time.seconds()
+    return np.asarray(time) / 1000.0
+
+# EOF
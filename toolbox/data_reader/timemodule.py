@@ -1,16 +1,191 @@
 # -*- coding: utf-8 -*-
 
+import re
 import time
 import datetime
 
+import numpy as np
+
 EXCHANGE_RATE_TO_SECOND = {'MS': 0.001, 'S': 1, 'MIN': 60, 'H': 3600}
 DEFAULT_FORMAT_STRING = ['%Y-%m-%d %H:%M:%S.%f', '%Y%m%d%H%M%S%f']
 
+# strings in one of the default layouts, the fraction of the second is optional
+DEFAULT_LAYOUT = re.compile(r'^(\d{4})-?(\d{2})-?(\d{2}) ?(\d{2}):?(\d{2}):?(\d{2})(?:\.?(\d{1,6}))?$')
+
+# the most entries kept in the caches below, they are emptied when full
+CACHE_SIZE = 4096
+
+# day (days since 1970-01-01) -> seconds the local time is ahead of UTC on that day,
+# None for the days the offset changes on (daylight saving time transitions)
+_day_offsets = {}
+
+# date prefix of the strings parsed recently -> (year, month, day)
+_date_prefixes = {}
+
+# (year, month, day) of the dates converted recently -> seconds since the epoch of their local
+# midnight, None for the days the offset changes on
+_midnights = {}
+
+
+def days_from_civil(year, month, day):
+    """days since 1970-01-01 of the dates, the arguments are integers or integer arrays"""
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def civil_from_days(days):
+    """the (year, month, day) of days since 1970-01-01, an integer or an integer array"""
+    days = days + 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_from_march = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_from_march + 2) // 5 + 1
+    month = month_from_march + 3 - 12 * (month_from_march >= 10)
+    return year_of_era + era * 400 + (month <= 2), month, day
+
+
+def day_offset(day):
+    """
+    The seconds the local time is ahead of UTC during the day, mktime is only called
+    for the first conversion of each day.
+    :return: The offset, None if it changes during the day
+    """
+    day = int(day)
+    if day in _day_offsets:
+        return _day_offsets[day]
+
+    year, month, month_day = civil_from_days(day)
+    next_year, next_month, next_month_day = civil_from_days(day + 1)
+    try:
+        start = time.mktime((year, month, month_day, 0, 0, 0, 0, 0, -1))
+        end = time.mktime((next_year, next_month, next_month_day, 0, 0, 0, 0, 0, -1))
+        offset = day * 86400 - start if end - start == 86400 else None
+    except (OverflowError, ValueError):
+        offset = None
+
+    if len(_day_offsets) >= CACHE_SIZE:
+        _day_offsets.clear()
+    _day_offsets[day] = offset
+    return offset
+
+
+def local_midnight(year, month, day):
+    """seconds since the epoch of the local midnight of the date, None if the offset changes during the day"""
+    key = (year, month, day)
+    if key in _midnights:
+        return _midnights[key]
+
+    day_number = days_from_civil(year, month, day)
+    offset = day_offset(day_number)
+    midnight = None if offset is None else day_number * 86400 - offset
+    if len(_midnights) >= CACHE_SIZE:
+        _midnights.clear()
+    _midnights[key] = midnight
+    return midnight
+
+
+def _offsets(days):
+    """the day_offset of every day of an integer array, NaN for None"""
+    unique_days, day_index = np.unique(days, return_inverse=True)
+    offsets = np.array([day_offset(unique_day) for unique_day in unique_days], dtype=np.float64)
+    return offsets[day_index]
+
+
+def local_to_epoch(year, month, day, hour, minute, second):
+    """
+    Seconds since the epoch of local times given by integer arrays of their fields,
+    *second* may have a fraction. The local time offset is looked up once per day.
+    """
+    days = days_from_civil(year, month, day)
+    epoch = days * 86400.0 + hour * 3600 + minute * 60 + second - _offsets(days)
+
+    # the days with a daylight saving time transition are converted row by row
+    for row in np.flatnonzero(np.isnan(epoch)):
+        whole_second = int(np.floor(second[row]))
+        epoch[row] = time.mktime((int(year[row]), int(month[row]), int(day[row]), int(hour[row]),
+                                  int(minute[row]), whole_second, 0, 0, -1)) + second[row] - whole_second
+    return epoch
+
+
+def parse_date_matrix(matrix):
+    """
+    Convert date strings laid out one per row in a uint8 matrix, in either of the
+    DEFAULT_FORMAT_STRING layouts, to milliseconds since the epoch in one pass:
+    the digit columns are combined arithmetically instead of parsing every string.
+    :return: A float64 array of the timestamps
+    """
+    if len(matrix) == 0:
+        return np.empty(0)
+
+    is_digit = (matrix >= ord('0')) & (matrix <= ord('9'))
+    if not (is_digit == is_digit[0]).all() or is_digit[0].sum() < 14:
+        raise ValueError('date strings do not share one of the default layouts')
+    digits = matrix[:, is_digit[0]].astype(np.int64) - ord('0')
+
+    def number(first, stop):
+        return digits[:, first:stop].dot(10 ** np.arange(stop - first - 1, -1, -1))
+
+    second = number(12, 14).astype(np.float64)
+    if digits.shape[1] > 14:
+        second += number(14, digits.shape[1]) / 10.0 ** (digits.shape[1] - 14)
+    return local_to_epoch(number(0, 4), number(4, 6), number(6, 8), number(8, 10), number(10, 12), second) * 1000.0
+
+
+def parse_date_strings(date_strings):
+    """
+    Convert date strings to milliseconds since the epoch in one vectorized pass.
+    :param date_strings: A sequence or array of strings sharing one of the DEFAULT_FORMAT_STRING layouts
+    :return: A float64 array of the timestamps
+    """
+    strings = np.asarray(date_strings)
+    if strings.dtype.kind == 'U':
+        strings = strings.astype('S')
+    strings = np.ascontiguousarray(strings.ravel())
+    return parse_date_matrix(strings.view(np.uint8).reshape(len(strings), strings.itemsize))
+
+
+def local_fields(timestamps):
+    """
+    The local (year, month, day, hour, minute, second, microsecond) integer arrays
+    of milliseconds since the epoch, converted in one vectorized pass.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    seconds = np.floor(timestamps / 1000.0)
+    microsecond = np.minimum(np.round((timestamps - seconds * 1000.0) * 1000), 999999).astype(np.int64)
+
+    # the offset of the UTC day is right when the local day it leads to has the same one
+    offsets = _offsets((seconds // 86400).astype(np.int64))
+    local = seconds + offsets
+    unsure = np.isnan(local)
+    unsure[~unsure] = _offsets((local[~unsure] // 86400).astype(np.int64)) != offsets[~unsure]
+    for row in np.flatnonzero(unsure):
+        local_time = time.localtime(seconds[row])
+        local[row] = days_from_civil(local_time.tm_year, local_time.tm_mon, local_time.tm_mday) * 86400 + \
+            local_time.tm_hour * 3600 + local_time.tm_min * 60 + local_time.tm_sec
+    local_days = local // 86400
+
+    local = local.astype(np.int64)
+    local_days = local_days.astype(np.int64)
+    year, month, day = civil_from_days(local_days)
+    second_of_day = local - local_days * 86400
+    return year, month, day, second_of_day // 3600, second_of_day // 60 % 60, second_of_day % 60, microsecond
+
 
 class DateTime(datetime.datetime):
     def timestamp(self, time_unit='MS'):
         exchange_rate = EXCHANGE_RATE_TO_SECOND[time_unit]
-        return (time.mktime(self.timetuple()) + self.microsecond / 1000000.0) / exchange_rate
+        midnight = local_midnight(self.year, self.month, self.day)
+        if midnight is None:
+            seconds = time.mktime(self.timetuple())
+        else:
+            seconds = midnight + self.hour * 3600 + self.minute * 60 + self.second
+        return (seconds + self.microsecond / 1000000.0) / exchange_rate
 
     @classmethod
     def fromtimetuple(cls, time_tuple):
@@ -22,6 +197,21 @@ class DateTime(datetime.datetime):
     @classmethod
     def fromstring(cls, date_string, format_string=None):
         if format_string is None:
+            # strings in a default layout are split by a regular expression instead of
+            # trying strptime with each format, the dates of recent strings are cached
+            match = DEFAULT_LAYOUT.match(date_string)
+            if match is not None:
+                prefix = date_string[:match.end(3)]
+                date = _date_prefixes.get(prefix)
+                if date is None:
+                    date = datetime.date(*[int(field) for field in match.group(1, 2, 3)])
+                    if len(_date_prefixes) >= CACHE_SIZE:
+                        _date_prefixes.clear()
+                    _date_prefixes[prefix] = date
+                fraction = match.group(7) or '0'
+                return DateTime(date.year, date.month, date.day, int(match.group(4)), int(match.group(5)),
+                                int(match.group(6)), int(fraction.ljust(6, '0')))
+
             for format_string in DEFAULT_FORMAT_STRING:
                 format_string = format_string[0:len(date_string) - 2]
                 try: